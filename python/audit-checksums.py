@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""
+  script to audit the archives already downloaded to a folder.
+
+  every zip under <folder>/data is hashed again and compared with the
+  .CHECKSUM next to it, or with the checksum the manifest recorded when the
+  .CHECKSUM is gone. files are hashed from read-only memory maps on a pool of
+  processes, so a large store is audited at disk speed instead of one core's.
+
+  only zips can be audited. an archive extracted to csv with -keep-csv 1, the
+  default of the download scripts, has no zip left to hash, so a store kept
+  that way is reported as unauditable (exit code 2) rather than as clean.
+  download with -keep-csv 0 to keep a store that can be audited.
+
+  with -quarantine 1 a corrupt archive is moved aside to <archive>.corrupt and
+  dropped from the manifest, so the next download run fetches it again and
+  rebuilds the merged outputs it fed.
+
+  e.g. ./audit-checksums.py -folder ./downloaded_data -quarantine 1
+
+"""
+import os
+import sys
+from argparse import ArgumentParser, RawTextHelpFormatter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from enums import *
+from manifest import Manifest, MANIFEST_FILE
+from utility import read_checksum_file, sha256_of_mmap, quarantine_file
+
+DEFAULT_OUTPUT_FOLDER = "./downloaded_klines"
+
+
+def find_archives(folder, manifest=None):
+  """[(zip path, expected sha256)] of every archive under folder/data that has a checksum to compare against."""
+  recorded = manifest.archive_checksums() if manifest else {}
+  archives = []
+  for zip_path in sorted((Path(folder) / 'data').rglob('*.zip')):
+    checksum_path = f"{zip_path}.CHECKSUM"
+    if os.path.exists(checksum_path):
+      archives.append((str(zip_path), read_checksum_file(checksum_path)))
+    elif os.path.abspath(zip_path) in recorded:
+      archives.append((str(zip_path), recorded[os.path.abspath(zip_path)]))
+  return archives
+
+def find_extracted_without_zip(folder):
+  """Extracted csvs under folder/data whose zip is gone, which can not be audited."""
+  return [str(csv_path) for csv_path in sorted((Path(folder) / 'data').rglob('*.csv')) if not csv_path.with_suffix('.zip').exists()]
+
+def audit_archives(archives, workers=CPU_WORKERS):
+  """Hashes the archives on workers processes. Returns [(path, expected, actual)] for the ones that do not match."""
+  paths = [path for path, _ in archives]
+  # big chunks keep the per-file pickling overhead down on stores with many small daily archives
+  chunksize = max(1, len(paths) // (workers * 4))
+  with ProcessPoolExecutor(max_workers=workers) as pool:
+    actuals = pool.map(sha256_of_mmap, paths, chunksize=chunksize)
+    return [(path, expected, actual) for (path, expected), actual in zip(archives, actuals) if actual != expected]
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Re-hash downloaded archives in parallel and compare them with their checksums",
+                            formatter_class=RawTextHelpFormatter)
+    parser.add_argument(
+        '-folder', dest='folder', default=DEFAULT_OUTPUT_FOLDER,
+        help='Folder the archives were downloaded to, default {}'.format(DEFAULT_OUTPUT_FOLDER))
+    parser.add_argument(
+        '-workers', dest='workers', default=CPU_WORKERS, type=int,
+        help='Number of processes hashing archives, default {}'.format(CPU_WORKERS))
+    parser.add_argument(
+        '-quarantine', dest='quarantine', default=0, type=int, choices=[0, 1],
+        help='1 to move corrupt archives aside to <archive>{} and drop them from the manifest, default 0'.format(QUARANTINE_SUFFIX))
+    args = parser.parse_args(sys.argv[1:])
+
+    manifest = Manifest(args.folder) if os.path.exists(os.path.join(args.folder, MANIFEST_FILE)) else None
+    archives = find_archives(args.folder, manifest)
+    unauditable = find_extracted_without_zip(args.folder)
+    if unauditable:
+      print(f"Warning: {len(unauditable)} extracted csvs in {args.folder} have no zip left to audit (downloaded with -keep-csv 1)")
+    print(f"Auditing {len(archives)} archives in {args.folder} with {args.workers} processes")
+    corrupt = audit_archives(archives, max(1, args.workers)) if archives else []
+
+    for path, expected, actual in corrupt:
+        print(f"Checksum mismatch: {path} (expected {expected}, got {actual})")
+        if args.quarantine == 1:
+            quarantine_path = quarantine_file(path)
+            if manifest is not None:
+                manifest.forget_archive(path)
+            print(f"Quarantined to {quarantine_path}")
+    print(f"Audited {len(archives)} archives, {len(corrupt)} corrupt")
+    if manifest is not None:
+        manifest.close()
+    if corrupt:
+      sys.exit(1)
+    # nothing audited is not a clean store
+    sys.exit(2 if unauditable and not archives else 0)
@@ -0,0 +1,127 @@
+"""
+  canonical merged kline datasets, one per trading type, symbol and interval.
+
+  a dataset is a folder of monthly csv partitions,
+  <folder>/merged/<type>/<SYMBOL>/<interval>/<SYMBOL>-<interval>-YYYY-MM.csv, each
+  sorted by open_time. its high-water mark is the last open_time written.
+  rows past the high-water mark are appended to the tail partition (or start
+  a new one), so a daily update costs as much as the new rows. rows at or
+  before it are late data; only the partitions they fall in are read back,
+  merged and rewritten. stale partitions, whose archives changed upstream,
+  are rebuilt from the archives alone.
+
+  partitions hold millisecond times unless the dataset is written with
+  unit='us', binance's native resolution since 2025. the manifest keeps
+  milliseconds either way. a partition in the other unit is converted when
+  it is next written, never appended to.
+
+  a partition is only appended to while its last row on disk is the one
+  the manifest recorded. rows left behind by an interrupted merge make the
+  partition rewritten instead, dropping the repeats.
+
+"""
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from enums import MERGED_FOLDER
+from readers import KLINE_COLUMNS, EPOCH_COLUMNS, TIME_UNIT_FACTORS, get_time_unit, convert_time_unit
+
+
+class DatasetUpdateError(Exception):
+  """A dataset update failed partway; partitions are those already written, to be recorded all the same."""
+
+  def __init__(self, message, partitions):
+    super().__init__(message)
+    self.partitions = partitions
+
+
+def get_partition_path(folder, symbol, interval, month, trading_type='spot'):
+  return os.path.join(folder, MERGED_FOLDER, trading_type, symbol.upper(), interval, f"{symbol.upper()}-{interval}-{month}.csv")
+
+def get_high_water_mark(partitions):
+  """Last open_time (ms) in the partitions that are not stale, or None."""
+  end_times = [partition['end_time'] for partition in partitions.values() if not partition['stale'] and partition['end_time'] is not None]
+  return max(end_times) if end_times else None
+
+def read_partition(path, unit='ms'):
+  """Reads a partition with its times in unit, whichever unit it was written in."""
+  df = pd.read_csv(path, dtype=KLINE_COLUMNS)
+  return convert_time_unit(df, EPOCH_COLUMNS['klines'], get_time_unit(df['open_time']), unit)
+
+def get_partition_unit(path):
+  return get_time_unit(pd.read_csv(path, dtype=KLINE_COLUMNS, nrows=1)['open_time'])
+
+def read_last_open_time(path):
+  """open_time (ms) of the last row of a partition on disk, read from its tail, or None when it has no rows."""
+  with open(path, 'rb') as f:
+    f.seek(0, os.SEEK_END)
+    f.seek(max(0, f.tell() - 4096))
+    lines = [line for line in f.read().splitlines() if line.strip()]
+  first_field = lines[-1].split(b',')[0] if lines else b''
+  if not first_field.isdigit():
+    return None
+  open_time = int(first_field)
+  return open_time // TIME_UNIT_FACTORS[get_time_unit([open_time])]
+
+def write_partition(df, path):
+  # write next to the partition and swap it in, so a crash never leaves half a partition
+  tmp_path = f"{path}.tmp"
+  df.to_csv(tmp_path, index=False)
+  os.replace(tmp_path, path)
+
+def update_dataset(df, symbol, interval, folder, partitions=None, unit='ms', trading_type='spot'):
+  """Adds the rows of df, sorted by open_time in unit ('ms' or 'us') and without duplicates, to the dataset of symbol and interval.
+
+  partitions is the dataset's current state, as from Manifest.dataset_partitions; it is updated
+  in place, so a merge can add its rows a chunk at a time.
+  Returns (path, symbol, start_ms, end_ms, rows, interval, trading_type) for every partition written.
+  Raises DatasetUpdateError, carrying the partitions written before the failure.
+  """
+  if partitions is None:
+    partitions = {}
+  if df.empty:
+    return []
+  high_water_mark = get_high_water_mark(partitions)
+  # months, the high-water mark and the manifest all go by milliseconds
+  open_times = df['open_time'].to_numpy(dtype=np.int64) // TIME_UNIT_FACTORS[unit]
+  months = np.datetime_as_string(open_times.astype('datetime64[ms]').astype('datetime64[M]'), unit='M')
+  late = open_times <= high_water_mark if high_water_mark is not None else np.zeros(len(df), dtype=bool)
+
+  written = []
+  try:
+    for month in np.unique(months):
+      in_month = months == month
+      rows = df[in_month]
+      partition = partitions.get(month)
+      path = partition['path'] if partition else get_partition_path(folder, symbol, interval, month, trading_type)
+      Path(path).parent.mkdir(parents=True, exist_ok=True)
+      exists = partition is not None and not partition['stale'] and os.path.exists(path)
+
+      if exists and not late[in_month].any() and get_partition_unit(path) == unit and read_last_open_time(path) == partition['end_time']:
+        # past the high-water mark: append, without reading the partition back
+        rows.to_csv(path, mode='a', header=False, index=False)
+        start_time = min(partition['start_time'], int(open_times[in_month][0]))
+        total_rows = partition['rows'] + len(rows)
+        print(f"Appended {len(rows)} rows to {path}")
+      else:
+        if exists:
+          # late data, another unit or rows an interrupted merge left: merge into this partition only, letting the new rows win
+          rows = pd.concat([read_partition(path, unit), rows], ignore_index=True)
+          rows = rows.drop_duplicates(subset=['open_time'], keep='last').sort_values('open_time', kind='stable')
+          print(f"Rewrote {path} with {len(df[in_month])} new rows")
+        else:
+          print(f"Wrote {path}")
+        write_partition(rows, path)
+        start_time = int(rows['open_time'].iloc[0]) // TIME_UNIT_FACTORS[unit]
+        total_rows = len(rows)
+      end_time = int(rows['open_time'].iloc[-1]) // TIME_UNIT_FACTORS[unit]
+      if exists and partition['end_time'] is not None:
+        end_time = max(end_time, partition['end_time'])
+      partitions[month] = {'path': path, 'start_time': start_time, 'end_time': end_time, 'rows': total_rows, 'stale': False}
+      written.append((path, symbol.upper(), start_time, end_time, total_rows, interval, trading_type))
+  except Exception as e:
+    raise DatasetUpdateError(str(e), written) from e
+  return written
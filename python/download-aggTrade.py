@@ -13,12 +13,13 @@ from argparse import ArgumentParser, RawTextHelpFormatter, ArgumentTypeError
 from datetime import *
 import pandas as pd
 from enums import *
-from utility import download_file, get_all_symbols, get_parser, get_start_end_date_objects, convert_to_date_object, \
+from utility import download_files, get_all_symbols, get_parser, get_start_end_date_objects, convert_to_date_object, \
   get_path
 
 
-def download_monthly_aggTrades(trading_type, symbols, num_symbols, years, months, start_date, end_date, folder, checksum):
+def download_monthly_aggTrades(trading_type, symbols, num_symbols, years, months, start_date, end_date, folder, checksum, max_in_flight=MAX_IN_FLIGHT):
   current = 0
+  jobs = []
   date_range = None
 
   if start_date and end_date:
@@ -44,17 +45,15 @@ def download_monthly_aggTrades(trading_type, symbols, num_symbols, years, months
         if current_date >= start_date and current_date <= end_date:
           path = get_path(trading_type, "aggTrades", "monthly", symbol)
           file_name = "{}-aggTrades-{}-{}.zip".format(symbol.upper(), year, '{:02d}'.format(month))
-          download_file(path, file_name, date_range, folder)
-
-          if checksum == 1:
-            checksum_path = get_path(trading_type, "aggTrades", "monthly", symbol)
-            checksum_file_name = "{}-aggTrades-{}-{}.zip.CHECKSUM".format(symbol.upper(), year, '{:02d}'.format(month))
-            download_file(checksum_path, checksum_file_name, date_range, folder)
+          jobs.append((path, file_name, date_range, folder, checksum))
     
     current += 1
 
-def download_daily_aggTrades(trading_type, symbols, num_symbols, dates, start_date, end_date, folder, checksum):
+  download_files(jobs, max_in_flight)
+
+def download_daily_aggTrades(trading_type, symbols, num_symbols, dates, start_date, end_date, folder, checksum, max_in_flight=MAX_IN_FLIGHT):
   current = 0
+  jobs = []
   date_range = None
 
   if start_date and end_date:
@@ -79,15 +78,12 @@ def download_daily_aggTrades(trading_type, symbols, num_symbols, dates, start_da
       if current_date >= start_date and current_date <= end_date:
         path = get_path(trading_type, "aggTrades", "daily", symbol)
         file_name = "{}-aggTrades-{}.zip".format(symbol.upper(), date)
-        download_file(path, file_name, date_range, folder)
-
-        if checksum == 1:
-          checksum_path = get_path(trading_type, "aggTrades", "daily", symbol)
-          checksum_file_name = "{}-aggTrades-{}.zip.CHECKSUM".format(symbol.upper(), date)
-          download_file(checksum_path, checksum_file_name, date_range, folder)
+        jobs.append((path, file_name, date_range, folder, checksum))
 
     current += 1
 
+  download_files(jobs, max_in_flight)
+
 if __name__ == "__main__":
     parser = get_parser('aggTrades')
     args = parser.parse_args(sys.argv[1:])
@@ -109,7 +105,7 @@ if __name__ == "__main__":
       dates = pd.date_range(end=datetime.today(), periods=period.days + 1).to_pydatetime().tolist()
       dates = [date.strftime("%Y-%m-%d") for date in dates]
       if args.skip_monthly == 0:
-        download_monthly_aggTrades(args.type, symbols, num_symbols, args.years, args.months, args.startDate, args.endDate, args.folder, args.checksum)
+        download_monthly_aggTrades(args.type, symbols, num_symbols, args.years, args.months, args.startDate, args.endDate, args.folder, args.checksum, args.max_in_flight)
     if args.skip_daily == 0:
-      download_daily_aggTrades(args.type, symbols, num_symbols, dates, args.startDate, args.endDate, args.folder, args.checksum)
+      download_daily_aggTrades(args.type, symbols, num_symbols, dates, args.startDate, args.endDate, args.folder, args.checksum, args.max_in_flight)
     
@@ -12,14 +12,15 @@ from datetime import *
 
 import pandas as pd
 
-from enums import START_DATE, END_DATE, DAILY_INTERVALS, PERIOD_START_DATE
-from utility import download_file, get_all_symbols, get_parser, convert_to_date_object, \
+from enums import START_DATE, END_DATE, DAILY_INTERVALS, PERIOD_START_DATE, MAX_IN_FLIGHT
+from utility import download_files, get_all_symbols, get_parser, convert_to_date_object, \
     get_path, raise_arg_error
 
 
 def download_monthly_indexPriceKlines(trading_type, symbols, num_symbols, intervals, years, months, start_date,
-                                      end_date, folder, checksum):
+                                      end_date, folder, checksum, max_in_flight=MAX_IN_FLIGHT):
     current = 0
+    jobs = []
     date_range = None
 
     if start_date and end_date:
@@ -46,20 +47,17 @@ def download_monthly_indexPriceKlines(trading_type, symbols, num_symbols, interv
                     if start_date <= current_date <= end_date:
                         path = get_path(trading_type, "indexPriceKlines", "monthly", symbol, interval)
                         file_name = "{}-{}-{}-{}.zip".format(symbol.upper(), interval, year, '{:02d}'.format(month))
-                        download_file(path, file_name, date_range, folder)
-
-                        if checksum == 1:
-                            checksum_path = get_path(trading_type, "indexPriceKlines", "monthly", symbol, interval)
-                            checksum_file_name = "{}-{}-{}-{}.zip.CHECKSUM".format(symbol.upper(), interval, year,
-                                                                                   '{:02d}'.format(month))
-                            download_file(checksum_path, checksum_file_name, date_range, folder)
+                        jobs.append((path, file_name, date_range, folder, checksum))
 
         current += 1
 
+    download_files(jobs, max_in_flight)
+
 
 def download_daily_indexPriceKlines(trading_type, symbols, num_symbols, intervals, dates, start_date, end_date, folder,
-                                    checksum):
+                                    checksum, max_in_flight=MAX_IN_FLIGHT):
     current = 0
+    jobs = []
     date_range = None
 
     if start_date and end_date:
@@ -87,15 +85,12 @@ def download_daily_indexPriceKlines(trading_type, symbols, num_symbols, interval
                 if start_date <= current_date <= end_date:
                     path = get_path(trading_type, "indexPriceKlines", "daily", symbol, interval)
                     file_name = "{}-{}-{}.zip".format(symbol.upper(), interval, date)
-                    download_file(path, file_name, date_range, folder)
-
-                    if checksum == 1:
-                        checksum_path = get_path(trading_type, "indexPriceKlines", "daily", symbol, interval)
-                        checksum_file_name = "{}-{}-{}.zip.CHECKSUM".format(symbol.upper(), interval, date)
-                        download_file(checksum_path, checksum_file_name, date_range, folder)
+                    jobs.append((path, file_name, date_range, folder, checksum))
 
         current += 1
 
+    download_files(jobs, max_in_flight)
+
 
 if __name__ == "__main__":
     parser = get_parser('klines')
@@ -120,6 +115,6 @@ if __name__ == "__main__":
         dates = pd.date_range(end=datetime.today(), periods=period.days + 1).to_pydatetime().tolist()
         dates = [date.strftime("%Y-%m-%d") for date in dates]
         download_monthly_indexPriceKlines(args.type, symbols, num_symbols, args.intervals, args.years, args.months,
-                                          args.startDate, args.endDate, args.folder, args.checksum)
+                                          args.startDate, args.endDate, args.folder, args.checksum, args.max_in_flight)
     download_daily_indexPriceKlines(args.type, symbols, num_symbols, args.intervals, dates, args.startDate,
-                                    args.endDate, args.folder, args.checksum)
+                                    args.endDate, args.folder, args.checksum, args.max_in_flight)
@@ -22,6 +22,7 @@ from utility import (
     get_all_symbols, get_parser, convert_to_date_object,
     get_path, raise_arg_error, get_destination_dir, get_download_url
 )
+from readers import read_archive
 
 # Helper function to save content downloaded by fgrequests
 def save_response_content(response, save_path, url_for_logging):
@@ -133,8 +134,8 @@ def merge_symbol_csvs(symbol, csv_file_paths, output_directory):
     all_dataframes = []
     for csv_path in csv_file_paths: # Iterate original or sorted, order doesn't matter for concat
         try:
-            # Read with header=0 so pandas uses the first row as header
-            df = pd.read_csv(csv_path, header=0)
+            # Typed read: int64 times and counts, float64 prices, nothing inferred
+            df = read_archive(csv_path, 'markPriceKlines')
             if df.empty:
                 print(f"Warning: Empty CSV file skipped: {csv_path}")
                 continue
@@ -167,7 +168,6 @@ def merge_symbol_csvs(symbol, csv_file_paths, output_directory):
             
         timestamp_col_name = canonical_header[0]
 
-        merged_df[timestamp_col_name] = pd.to_numeric(merged_df[timestamp_col_name])
         merged_df.sort_values(by=timestamp_col_name, inplace=True)
 
         min_timestamp_ms = merged_df[timestamp_col_name].min()
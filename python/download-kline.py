@@ -19,6 +19,7 @@ import re
 import numpy as np
 from utility import get_all_symbols, get_parser, get_start_end_date_objects, convert_to_date_object, \
   get_path, get_download_url, get_destination_dir # Removed download_file, added get_download_url, get_destination_dir
+from readers import read_klines
 
 DEFAULT_OUTPUT_FOLDER = "./downloaded_klines"
 CHUNK_SIZE = 300 # Max requests per batch for fgrequests
@@ -322,8 +323,7 @@ def merge_symbol_klines_csvs(symbol, csv_file_paths, output_directory):
             print(f"Warning: File not found {f_path_str}, skipping.")
             continue
         try:
-            df = pd.read_csv(f_path, header=None)
-            df.columns = CANONICAL_KLINES_HEADERS
+            df = read_klines(f_path)
             all_dfs.append(df)
         except pd.errors.EmptyDataError:
             print(f"Warning: Empty CSV file encountered: {f_path_str}, skipping.")
@@ -11,28 +11,35 @@ import sys
 import os
 from datetime import *
 import pandas as pd
-import fgrequests
 import zipfile
 from pathlib import Path
 from enums import *
 import re
 import numpy as np
-from utility import get_all_symbols, get_parser, get_start_end_date_objects, convert_to_date_object, \
-  get_path, get_download_url, get_destination_dir # Removed download_file, added get_download_url, get_destination_dir
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from itertools import chain, repeat
+from utility import get_symbol_catalogue, filter_symbols, get_parser, get_start_end_date_objects, convert_to_date_object, \
+  get_path, get_download_url, get_destination_dir, read_checksum_file # Removed download_file, added get_download_url, get_destination_dir
+from downloader import run_downloads, load_failed_requests, AdaptiveConcurrency, PlannedRequest, CompletionTracker
+from planner import iter_listings, is_listed, discover_first_months
+from manifest import Manifest, parse_archive_name
+from readers import iter_klines, get_time_unit, convert_time_unit, ENGINES, EPOCH_COLUMNS, TIME_UNITS, TIME_UNIT_FACTORS
+from dataset import update_dataset, DatasetUpdateError
+from merger import merge_sorted_chunks, rechunk, external_sort, UnsortedSourceError
 
 DEFAULT_OUTPUT_FOLDER = "./downloaded_klines"
-CHUNK_SIZE = 300 # Max requests per batch for fgrequests
+FAILED_DOWNLOADS_FILE = "failed_downloads.jsonl"
 
 CANONICAL_KLINES_HEADERS = ['open_time', 'open', 'high', 'low', 'close', 'volume', 'close_time', 'quote_volume', 'count', 'taker_buy_volume', 'taker_buy_quote_volume', 'ignore']
 
-def save_response_content(response, destination_path, symbol, interval, extracted_files_map):
-    """Saves the content of a successful fgrequests response and unzips if it's a zip file."""
-    try:
-        # Ensure the directory exists
-        Path(destination_path).parent.mkdir(parents=True, exist_ok=True)
+def unzip_downloaded_archive(destination_path, symbol):
+    """Unzips an archive the download engine has already streamed to disk, then removes the zip.
 
-        with open(destination_path, 'wb') as f:
-            f.write(response.content)
+    Returns the extracted CSV paths. Safe to run on a worker thread: it only touches the archive's own files.
+    """
+    extracted_csv_paths = []
+    try:
         print(f"Saved: {destination_path}")
 
         if destination_path.endswith(".zip"):
@@ -43,9 +50,7 @@ def save_response_content(response, destination_path, symbol, interval, extracte
                         zip_ref.extract(member, unzip_dir)
                         extracted_csv_path = str(unzip_dir / member)
                         print(f"Unzipped: {extracted_csv_path}")
-                        if symbol not in extracted_files_map:
-                            extracted_files_map[symbol] = []
-                        extracted_files_map[symbol].append(extracted_csv_path)
+                        extracted_csv_paths.append(extracted_csv_path)
             # After successful extraction from the zip, remove the zip file
             try:
                 os.remove(destination_path)
@@ -54,14 +59,200 @@ def save_response_content(response, destination_path, symbol, interval, extracte
                 print(f"Error removing zip file {destination_path}: {e}")
                         
     except Exception as e:
-        print(f"Error saving/unzipping {destination_path} for {symbol}: {e}")
+        print(f"Error unzipping {destination_path} for {symbol}: {e}")
+    return extracted_csv_paths
+
+
+def add_monthly_coverage(coverage, destination_path):
+    """Adds the month a monthly archive covers to coverage as (symbol, interval, 'YYYY-MM')."""
+    parsed = parse_archive_name(destination_path)
+    if coverage is not None and parsed and parsed[2] == 'monthly':
+        coverage.add((parsed[0], parsed[1], parsed[3].strftime('%Y-%m')))
+
+
+def download_requests(planned_requests, label, max_in_flight, extracted_files_map, folder, adaptive=1, manifest=None, coverage=None, keep_csv=1, cpu_workers=CPU_WORKERS, tracker=None):
+    """Runs the planned requests through the download engine and saves each response as it completes.
+
+    planned_requests can be a generator; the engine pulls from it only as slots free up.
+    Every saved archive is recorded in the manifest. Requests carrying the etag / last_modified
+    of an earlier download are conditional and leave the local copy alone on a 304.
+    Months whose monthly archive is saved or unchanged are added to the coverage set.
+    Requests that still fail after the engine's retries are appended to FAILED_DOWNLOADS_FILE in folder.
+    With adaptive=1 the engine tunes its in-flight limit at runtime, using max_in_flight as the ceiling.
+    With keep_csv=0 archives stay zipped and the merge reads them in memory instead of from extracted CSVs.
+    Unzipping runs on cpu_workers threads while the network keeps downloading; the manifest and the
+    maps passed in are only written from this thread.
+    Every finished request is reported to tracker, if given, under its symbol.
+    Returns the number of requests completed.
+    """
+    mode = "adaptive, ceiling" if adaptive == 1 else "max in flight"
+    print(f"Downloading {label} files as they are planned ({mode} {max_in_flight})...")
+    completed = 0
+
+    def process_response(request, response):
+        # CPU stage, on the worker pool
+        if response.status_code == 304 or request.is_checksum:
+            return None
+        destination_path = request.destination_path
+        size = os.path.getsize(destination_path)
+        if keep_csv == 1:
+            extracted = unzip_downloaded_archive(destination_path, request.symbol)
+        else:
+            print(f"Saved: {destination_path}")
+            extracted = [destination_path]
+        return size, extracted
+
+    def handle_response(request, response, processed=None):
+        # writer stage, back on this thread
+        nonlocal completed
+        completed += 1
+        if response is not None and response.status_code == 304:
+            print(f"Unchanged: {request.url}")
+            add_monthly_coverage(coverage, request.destination_path)
+        elif response is not None and response.ok:
+            destination_path = request.destination_path
+            if not request.is_checksum:
+                size, extracted = processed
+                # read here rather than in the CPU stage, so a .CHECKSUM saved meanwhile is not missed
+                checksum_path = f"{destination_path}.CHECKSUM"
+                checksum = read_checksum_file(checksum_path) if os.path.exists(checksum_path) else None
+                extracted_files_map.setdefault(request.symbol, []).extend(extracted)
+                changed = manifest.record_archive(request.url, destination_path, extracted[0] if extracted else None, size,
+                                                  response.headers.get('etag', '').strip('"') or None, response.headers.get('last-modified'), checksum)
+                if changed:
+                    print(f"Changed upstream: {request.url}. Merged outputs covering it are marked stale.")
+                add_monthly_coverage(coverage, destination_path)
+            else:
+                print(f"Saved checksum: {destination_path}")
+                manifest.record_checksum(request.url[:-len('.CHECKSUM')], read_checksum_file(destination_path))
+        else:
+            status_code = response.status_code if response is not None else "N/A"
+            if response is not None:
+                error_message = response.reason if response.reason else f"Status {response.status_code}"
+            else:
+                error_message = "No response or connection error"
+            if status_code == 404:
+                print(f"File not found: {request.url}")
+                manifest.record_missing(request.url)
+            else:
+                print(f"Failed to download {request.url} (HTTP {status_code} - {error_message}). Recorded in {FAILED_DOWNLOADS_FILE}.")
+        if tracker is not None:
+            tracker.finished(request.symbol)
+
+    if manifest is None:
+        manifest = Manifest(folder)
+    controller = AdaptiveConcurrency(max_in_flight) if adaptive == 1 else None
+    run_downloads(planned_requests, handle_response, max_in_flight, os.path.join(folder, FAILED_DOWNLOADS_FILE), controller,
+                  process_response, cpu_workers)
+    manifest.commit()
+    if completed:
+        print(f"Finished {completed} {label} requests")
+    else:
+        print(f"No {label} files to download based on the criteria.")
+    return completed
+
+
+def revalidate_klines(symbols, max_in_flight, folder, adaptive=1, manifest=None, keep_csv=1, cpu_workers=CPU_WORKERS, trading_type=None):
+  """Sends one conditional request per archive of symbols in the manifest and re-downloads only the ones that changed upstream.
+
+  A changed archive kept with a .CHECKSUM is verified against the current one, which is only
+  fetched then. Merged outputs that overlap a changed archive are marked stale, so the merge step rebuilds them.
+  """
+  if manifest is None:
+    manifest = Manifest(folder)
+  extracted_files_map_for_function = {}
+  archives = manifest.archives_to_revalidate(symbols, trading_type)
+  download_requests((PlannedRequest(url, path, symbol, interval, etag=etag, last_modified=last_modified,
+                                    checksum_url=f"{url}.CHECKSUM" if os.path.exists(f"{path}.CHECKSUM") else None)
+                     for url, path, symbol, interval, etag, last_modified in archives),
+                    "revalidated", max_in_flight, extracted_files_map_for_function, folder, adaptive, manifest, keep_csv=keep_csv, cpu_workers=cpu_workers)
+  return extracted_files_map_for_function
+
+
+def get_effective_start_date(symbol, start_date_obj, end_date_obj, manifest, label, first_date=None, interval=None, trading_type=None):
+  """Moves start_date_obj up to first_date, the symbol's first day of data, and past the data already merged for it (at interval and trading_type)."""
+  if first_date and first_date > start_date_obj:
+    start_date_obj = first_date
+  latest_merged_end_date = manifest.latest_merged_end_date(symbol, interval, trading_type)
+  if not latest_merged_end_date:
+    return start_date_obj
+  effective_start_date_obj = max(start_date_obj, latest_merged_end_date + timedelta(days=1))
+  if effective_start_date_obj > end_date_obj:
+    print(f"Symbol {symbol} {interval or ''}: Adjusted start date {effective_start_date_obj} is after overall end date {end_date_obj}. No new {label} data will be downloaded for this symbol.")
+  else:
+    print(f"Symbol {symbol} {interval or ''}: Found existing merged data ending on {latest_merged_end_date}. Adjusted download start date to: {effective_start_date_obj}")
+  return effective_start_date_obj
+
+
+def plan_monthly_requests(trading_type, symbols, intervals, years, months, start_date_obj, end_date_obj, folder, checksum, listings, manifest, first_dates=None, first_months=None, tracker=None):
+  """Yields the monthly requests one at a time, so downloads start while the rest are still being planned.
+
+  listings yields each symbol's {prefix: objects} in turn, as from planner.iter_listings, or is None to plan without.
+  first_dates maps symbols to the day they listed, and first_months maps monthly
+  prefixes to their first archive month; nothing before either is requested.
+  Every request is counted in tracker, if given, and a symbol is closed once all of it is planned.
+  """
+  num_symbols = len(symbols)
+  skipped_unlisted = 0
+  skipped_missing = 0
+  known_missing = manifest.known_missing_urls()
 
+  # first day of every requested month, sorted, as one datetime64 array
+  month_starts = np.unique(np.array([f"{year}-{int(month):02d}-01" for year in years for month in months], dtype='datetime64[D]'))
+  end_day = np.datetime64(end_date_obj, 'D')
 
-def download_monthly_klines(trading_type, symbols, num_symbols, intervals, years, months, start_date, end_date, folder, checksum):
-  current = 0
+  # one symbol's listings at a time, let go once it is planned
+  for current, (symbol, listing) in enumerate(zip(symbols, listings if listings is not None else repeat({}))):
+    print(f"[{current+1}/{num_symbols}] - Preparing monthly {symbol} klines for download")
+    first_date = first_dates.get(symbol.upper()) if first_dates else None
+
+    for interval in intervals:
+      # the listing month has a (partial) monthly archive of its own
+      effective_start_date_obj_for_symbol = get_effective_start_date(symbol, start_date_obj, end_date_obj, manifest, "monthly",
+                                                                     first_date.replace(day=1) if first_date else None, interval, trading_type)
+      selected = month_starts[(month_starts >= np.datetime64(effective_start_date_obj_for_symbol, 'D')) & (month_starts <= end_day)]
+      month_strs = np.datetime_as_string(selected, unit='M')
+      path_segment = get_path(trading_type, "klines", "monthly", symbol, interval)
+      first_month = first_months.get(path_segment) if first_months else None
+      for month_str in (month_strs[month_strs >= first_month] if first_month else month_strs):
+        file_name = "{}-{}-{}.zip".format(symbol.upper(), interval, month_str)
+        full_url = get_download_url(f"{path_segment}{file_name}")
+        if full_url in known_missing:
+          skipped_missing += 1
+          continue
+        if not is_listed(listing, path_segment, file_name):
+          skipped_unlisted += 1
+          continue
+        destination_path = get_destination_dir(os.path.join(path_segment, file_name), folder)
+        etag, last_modified = manifest.archive_validators(full_url)
+        # with -c 1 the .CHECKSUM is fetched on demand by the archive's own download and verified against the streamed hash
+        checksum_file_name = f"{file_name}.CHECKSUM"
+        checksum_full_url = get_download_url(f"{path_segment}{checksum_file_name}")
+        verify = checksum == 1 and checksum_full_url not in known_missing and is_listed(listing, path_segment, checksum_file_name)
+        if tracker is not None:
+          tracker.planned(symbol)
+        yield PlannedRequest(full_url, destination_path, symbol, interval, etag=etag, last_modified=last_modified,
+                             checksum_url=checksum_full_url if verify else None)
+    if tracker is not None:
+      tracker.close(symbol)
+
+  if skipped_missing:
+    print(f"Skipped {skipped_missing} monthly archives known to be missing")
+  if skipped_unlisted:
+    print(f"Skipped {skipped_unlisted} monthly archives that are not in the bucket listing")
+
+
+def download_monthly_klines(trading_type, symbols, num_symbols, intervals, years, months, start_date, end_date, folder, checksum, max_in_flight=MAX_IN_FLIGHT, adaptive=1, use_listing=1, manifest=None, coverage=None, first_dates=None, first_months=None, keep_csv=1, cpu_workers=CPU_WORKERS, tracker=None):
+  """Downloads the monthly archives in range. Months that end up on disk are added to coverage, if given.
+
+  first_dates maps symbols to their listing date and first_months monthly prefixes to their
+  first archive month, so months before either are never requested.
+  """
   if folder is None:
     folder = DEFAULT_OUTPUT_FOLDER
   Path(folder).mkdir(parents=True, exist_ok=True)
+  if manifest is None:
+    manifest = Manifest(folder)
 
   extracted_files_map_for_function = {}
 
@@ -76,98 +267,93 @@ def download_monthly_klines(trading_type, symbols, num_symbols, intervals, years
     end_date_obj = convert_to_date_object(end_date)
 
   print("Found {} symbols for monthly download".format(num_symbols))
-  
-  all_requests_metadata = [] # Changed name from all_requests to match user's conceptual flow
 
-  for symbol in symbols:
-    print(f"[{current+1}/{num_symbols}] - Preparing monthly {symbol} klines for download")
-    effective_start_date_obj_for_symbol = start_date_obj
-    output_folder_path = Path(folder)
-    merged_file_pattern = f"{symbol.upper()}_*_*.csv"
-    latest_merged_end_date = None
-    for merged_file in output_folder_path.glob(merged_file_pattern):
-        try:
-            symbol_prefix_in_filename = symbol.upper() + "_"
-            if not merged_file.stem.startswith(symbol_prefix_in_filename):
-                continue
-            dates_section = merged_file.stem[len(symbol_prefix_in_filename):]
-            date_strings = dates_section.split('_')
-            if len(date_strings) == 2:
-                end_date_str_from_file = date_strings[1]
-                parsed_end_date = datetime.strptime(end_date_str_from_file, "%Y%m%d").date()
-                if latest_merged_end_date is None or parsed_end_date > latest_merged_end_date:
-                    latest_merged_end_date = parsed_end_date
-            else:
-                print(f"Warning: Merged filename {merged_file.name} for symbol {symbol} not in expected format SYMBOL_STARTDATE_ENDDATE.csv after prefix. Dates part: {dates_section}")
-        except ValueError:
-            print(f"Warning: Could not parse date from merged file {merged_file.name} for symbol {symbol}.")
-        except Exception as e_parse:
-            print(f"Warning: Error parsing merged file {merged_file.name} for symbol {symbol}: {e_parse}")
-    if latest_merged_end_date:
-        calculated_new_start_date = latest_merged_end_date + timedelta(days=1)
-        effective_start_date_obj_for_symbol = max(start_date_obj, calculated_new_start_date)
-        if effective_start_date_obj_for_symbol > end_date_obj:
-            print(f"Symbol {symbol}: Adjusted start date {effective_start_date_obj_for_symbol} is after overall end date {end_date_obj}. No new monthly data will be downloaded for this symbol.")
-        else:
-            print(f"Symbol {symbol}: Found existing merged data ending on {latest_merged_end_date}. Adjusted download start date to: {effective_start_date_obj_for_symbol}")
+  listings = None
+  if use_listing == 1:
+    listings = iter_listings(([get_path(trading_type, "klines", "monthly", symbol, interval) for interval in intervals] for symbol in symbols), max_in_flight)
 
-    for interval in intervals:
-      for year in years:
-        for month in months:
-          current_date = convert_to_date_object('{}-{}-01'.format(year, month))
-          if current_date >= effective_start_date_obj_for_symbol and current_date <= end_date_obj:
-            path_segment = get_path(trading_type, "klines", "monthly", symbol, interval)
-            file_name = "{}-{}-{}-{}.zip".format(symbol.upper(), interval, year, '{:02d}'.format(month))
-            full_url = get_download_url(f"{path_segment}{file_name}")
-            destination_path = get_destination_dir(os.path.join(path_segment, file_name), folder)
-            all_requests_metadata.append({'url': full_url, 'method': 'GET', 'params': {'destination_path': destination_path, 'symbol': symbol, 'interval': interval}})
-            if checksum == 1:
-              checksum_file_name = f"{file_name}.CHECKSUM"
-              checksum_full_url = get_download_url(f"{path_segment}{checksum_file_name}")
-              checksum_destination_path = get_destination_dir(os.path.join(path_segment, checksum_file_name), folder)
-              all_requests_metadata.append({'url': checksum_full_url, 'method': 'GET', 'params': {'destination_path': checksum_destination_path, 'symbol': symbol, 'interval': interval, 'is_checksum': True}})
-    current += 1
-
-  if all_requests_metadata:
-    print(f"Preparing to download {len(all_requests_metadata)} monthly files (chunk size {CHUNK_SIZE})...")
-    for i in range(0, len(all_requests_metadata), CHUNK_SIZE):
-        chunk_metadata = all_requests_metadata[i:i + CHUNK_SIZE]
-        chunk_urls = [req['url'] for req in chunk_metadata]
-        
-        print(f"Processing monthly batch of {len(chunk_urls)} requests (chunk {i//CHUNK_SIZE + 1}/{ (len(all_requests_metadata) + CHUNK_SIZE -1) // CHUNK_SIZE })")
-        responses = fgrequests.build(chunk_urls, max_retries=2) # Reverted to max_retries=2
-
-        for j, response in enumerate(responses):
-            req_details = chunk_metadata[j]
-            if response and response.ok:
-                if not req_details['params'].get('is_checksum', False):
-                     save_response_content(response, req_details['params']['destination_path'], req_details['params']['symbol'], req_details['params']['interval'], extracted_files_map_for_function)
-                else:
-                    Path(req_details['params']['destination_path']).parent.mkdir(parents=True, exist_ok=True)
-                    with open(req_details['params']['destination_path'], 'wb') as f:
-                        f.write(response.content)
-                    print(f"Saved checksum: {req_details['params']['destination_path']}")
-            else:
-                status_code = response.status_code if response else "N/A"
-                error_message = "Unknown error"
-                if response:
-                    try:
-                        error_message = response.reason if hasattr(response, 'reason') and response.reason else f"Status {response.status_code}"
-                    except Exception:
-                        error_message = f"Status {response.status_code}, reason attribute error"
-                else:
-                    error_message = "No response or connection error"
-                print(f"Failed to download {req_details['url']} (HTTP {status_code} - {error_message}). Not re-queueing.")
-  else:
-    print("No monthly files to download based on the criteria.")
+  planned_requests = plan_monthly_requests(trading_type, symbols, intervals, years, months, start_date_obj, end_date_obj, folder, checksum, listings, manifest, first_dates, first_months, tracker)
+  download_requests(planned_requests, "monthly", max_in_flight, extracted_files_map_for_function, folder, adaptive, manifest, coverage, keep_csv, cpu_workers, tracker)
   return extracted_files_map_for_function
 
 
-def download_daily_klines(trading_type, symbols, num_symbols, intervals, dates, start_date, end_date, folder, checksum):
-  current = 0
+def plan_daily_requests(trading_type, symbols, intervals, dates, start_date_obj, end_date_obj, folder, checksum, listings, manifest, coverage=None, first_dates=None, first_months=None, tracker=None):
+  """Yields the daily requests one at a time, skipping days whose month is in coverage.
+
+  dates can be YYYY-MM-DD strings or a datetime64 array. listings yields each symbol's
+  {prefix: objects} in turn, as from planner.iter_listings, or is None. first_dates maps symbols
+  to the day they listed, and first_months maps monthly prefixes to their first
+  archive month; no day before either is requested.
+  Every request is counted in tracker, if given, and a symbol is closed once all of it is planned.
+  """
+  num_symbols = len(symbols)
+  skipped_unlisted = 0
+  skipped_missing = 0
+  known_missing = manifest.known_missing_urls()
+  covered_archives = covered_requests = covered_bytes = 0
+
+  days = np.unique(np.asarray(dates, dtype='datetime64[D]'))
+  end_day = np.datetime64(end_date_obj, 'D')
+
+  # one symbol's listings at a time, let go once it is planned
+  for current, (symbol, listing) in enumerate(zip(symbols, listings if listings is not None else repeat({}))):
+    print(f"[{current+1}/{num_symbols}] - Preparing daily {symbol} klines for download")
+    first_date = first_dates.get(symbol.upper()) if first_dates else None
+
+    for interval in intervals:
+      effective_start_date_obj_for_symbol = get_effective_start_date(symbol, start_date_obj, end_date_obj, manifest, "daily", first_date, interval, trading_type)
+      # clip the whole day array to this symbol's range in one step
+      selected = days[(days >= np.datetime64(effective_start_date_obj_for_symbol, 'D')) & (days <= end_day)]
+      date_strs = np.datetime_as_string(selected, unit='D')
+      path_segment = get_path(trading_type, "klines", "daily", symbol, interval)
+      first_month = first_months.get(get_path(trading_type, "klines", "monthly", symbol, interval)) if first_months else None
+      for date_str in (date_strs[date_strs >= f"{first_month}-01"] if first_month else date_strs):
+        file_name = "{}-{}-{}.zip".format(symbol.upper(), interval, date_str)
+        full_url = get_download_url(f"{path_segment}{file_name}")
+        if full_url in known_missing:
+          skipped_missing += 1
+          continue
+        if not is_listed(listing, path_segment, file_name):
+          skipped_unlisted += 1
+          continue
+        if coverage and (symbol.upper(), interval, date_str[:7]) in coverage:
+          covered_archives += 1
+          covered_requests += 2 if checksum == 1 else 1
+          covered_bytes += (listing.get(path_segment) or {}).get(f"{path_segment}{file_name}", (0, None))[0]
+          continue
+        destination_path = get_destination_dir(os.path.join(path_segment, file_name), folder)
+        etag, last_modified = manifest.archive_validators(full_url)
+        # with -c 1 the .CHECKSUM is fetched on demand by the archive's own download and verified against the streamed hash
+        checksum_file_name = f"{file_name}.CHECKSUM"
+        checksum_full_url = get_download_url(f"{path_segment}{checksum_file_name}")
+        verify = checksum == 1 and checksum_full_url not in known_missing and is_listed(listing, path_segment, checksum_file_name)
+        if tracker is not None:
+          tracker.planned(symbol)
+        yield PlannedRequest(full_url, destination_path, symbol, interval, etag=etag, last_modified=last_modified,
+                             checksum_url=checksum_full_url if verify else None)
+    if tracker is not None:
+      tracker.close(symbol)
+
+  if skipped_missing:
+    print(f"Skipped {skipped_missing} daily archives known to be missing")
+  if skipped_unlisted:
+    print(f"Skipped {skipped_unlisted} daily archives that are not in the bucket listing")
+  if covered_archives:
+    saved_bytes = f", {covered_bytes / 1024 / 1024:.1f} MB" if covered_bytes else ""
+    print(f"Skipped {covered_archives} daily archives already covered by monthly archives (saved {covered_requests} requests{saved_bytes})")
+
+
+def download_daily_klines(trading_type, symbols, num_symbols, intervals, dates, start_date, end_date, folder, checksum, max_in_flight=MAX_IN_FLIGHT, adaptive=1, use_listing=1, manifest=None, coverage=None, first_dates=None, first_months=None, keep_csv=1, cpu_workers=CPU_WORKERS, tracker=None):
+  """Downloads the daily archives in range, except for days whose month is in coverage from the monthly run.
+
+  first_dates maps symbols to their listing date and first_months monthly prefixes to their
+  first archive month, so days before either are never requested.
+  """
   if folder is None:
     folder = DEFAULT_OUTPUT_FOLDER
   Path(folder).mkdir(parents=True, exist_ok=True)
+  if manifest is None:
+    manifest = Manifest(folder)
   
   extracted_files_map_for_function = {}
 
@@ -184,88 +370,12 @@ def download_daily_klines(trading_type, symbols, num_symbols, intervals, dates,
   valid_intervals = list(set(intervals) & set(DAILY_INTERVALS))
   print(f"Found {num_symbols} symbols for daily download with intervals: {valid_intervals}")
 
-  all_requests_metadata = [] # Changed name from all_requests
+  listings = None
+  if use_listing == 1:
+    listings = iter_listings(([get_path(trading_type, "klines", "daily", symbol, interval) for interval in valid_intervals] for symbol in symbols), max_in_flight)
 
-  for symbol in symbols:
-    print(f"[{current+1}/{num_symbols}] - Preparing daily {symbol} klines for download")
-    effective_start_date_obj_for_symbol = start_date_obj
-    output_folder_path = Path(folder)
-    merged_file_pattern = f"{symbol.upper()}_*_*.csv"
-    latest_merged_end_date = None
-    for merged_file in output_folder_path.glob(merged_file_pattern):
-        try:
-            symbol_prefix_in_filename = symbol.upper() + "_"
-            if not merged_file.stem.startswith(symbol_prefix_in_filename):
-                continue
-            dates_section = merged_file.stem[len(symbol_prefix_in_filename):]
-            date_strings = dates_section.split('_')
-            if len(date_strings) == 2:
-                end_date_str_from_file = date_strings[1]
-                parsed_end_date = datetime.strptime(end_date_str_from_file, "%Y%m%d").date()
-                if latest_merged_end_date is None or parsed_end_date > latest_merged_end_date:
-                    latest_merged_end_date = parsed_end_date
-            else:
-                print(f"Warning: Merged filename {merged_file.name} for symbol {symbol} not in expected format SYMBOL_STARTDATE_ENDDATE.csv after prefix. Dates part: {dates_section}")
-        except ValueError:
-            print(f"Warning: Could not parse date from merged file {merged_file.name} for symbol {symbol}.")
-        except Exception as e_parse:
-            print(f"Warning: Error parsing merged file {merged_file.name} for symbol {symbol}: {e_parse}")
-    if latest_merged_end_date:
-        calculated_new_start_date = latest_merged_end_date + timedelta(days=1)
-        effective_start_date_obj_for_symbol = max(start_date_obj, calculated_new_start_date)
-        if effective_start_date_obj_for_symbol > end_date_obj:
-            print(f"Symbol {symbol}: Adjusted start date {effective_start_date_obj_for_symbol} is after overall end date {end_date_obj}. No new daily data will be downloaded for this symbol.")
-        else:
-            print(f"Symbol {symbol}: Found existing merged data ending on {latest_merged_end_date}. Adjusted download start date to: {effective_start_date_obj_for_symbol}")
-
-    for interval in valid_intervals:
-      for date_str in dates:
-        current_date = convert_to_date_object(date_str)
-        if current_date >= effective_start_date_obj_for_symbol and current_date <= end_date_obj:
-          path_segment = get_path(trading_type, "klines", "daily", symbol, interval)
-          file_name = "{}-{}-{}.zip".format(symbol.upper(), interval, date_str)
-          full_url = get_download_url(f"{path_segment}{file_name}")
-          destination_path = get_destination_dir(os.path.join(path_segment, file_name), folder)
-          all_requests_metadata.append({'url': full_url, 'method': 'GET', 'params': {'destination_path': destination_path, 'symbol': symbol, 'interval': interval}})
-          if checksum == 1:
-            checksum_file_name = f"{file_name}.CHECKSUM"
-            checksum_full_url = get_download_url(f"{path_segment}{checksum_file_name}")
-            checksum_destination_path = get_destination_dir(os.path.join(path_segment, checksum_file_name), folder)
-            all_requests_metadata.append({'url': checksum_full_url, 'method': 'GET', 'params': {'destination_path': checksum_destination_path, 'symbol': symbol, 'interval': interval, 'is_checksum': True}})
-    current += 1
-  
-  if all_requests_metadata:
-    print(f"Preparing to download {len(all_requests_metadata)} daily files (chunk size {CHUNK_SIZE})...")
-    for i in range(0, len(all_requests_metadata), CHUNK_SIZE):
-        chunk_metadata = all_requests_metadata[i:i + CHUNK_SIZE]
-        chunk_urls = [req['url'] for req in chunk_metadata]
-
-        print(f"Processing daily batch of {len(chunk_urls)} requests (chunk {i//CHUNK_SIZE + 1}/{ (len(all_requests_metadata) + CHUNK_SIZE -1) // CHUNK_SIZE })")
-        responses = fgrequests.build(chunk_urls, max_retries=2) # Reverted to max_retries=2
-
-        for j, response in enumerate(responses):
-            req_details = chunk_metadata[j]
-            if response and response.ok:
-                if not req_details['params'].get('is_checksum', False):
-                    save_response_content(response, req_details['params']['destination_path'], req_details['params']['symbol'], req_details['params']['interval'], extracted_files_map_for_function)
-                else:
-                    Path(req_details['params']['destination_path']).parent.mkdir(parents=True, exist_ok=True)
-                    with open(req_details['params']['destination_path'], 'wb') as f:
-                        f.write(response.content)
-                    print(f"Saved checksum: {req_details['params']['destination_path']}")
-            else:
-                status_code = response.status_code if response else "N/A"
-                error_message = "Unknown error"
-                if response:
-                    try:
-                        error_message = response.reason if hasattr(response, 'reason') and response.reason else f"Status {response.status_code}"
-                    except Exception:
-                         error_message = f"Status {response.status_code}, reason attribute error"
-                else:
-                    error_message = "No response or connection error"
-                print(f"Failed to download {req_details['url']} (HTTP {status_code} - {error_message}). Not re-queueing.")
-  else:
-    print("No daily files to download based on the criteria.")
+  planned_requests = plan_daily_requests(trading_type, symbols, valid_intervals, dates, start_date_obj, end_date_obj, folder, checksum, listings, manifest, coverage, first_dates, first_months, tracker)
+  download_requests(planned_requests, "daily", max_in_flight, extracted_files_map_for_function, folder, adaptive, manifest, keep_csv=keep_csv, cpu_workers=cpu_workers, tracker=tracker)
   return extracted_files_map_for_function
 
 
@@ -307,144 +417,180 @@ def parse_date_from_filename(filename):
     return date(1970, 1, 1)
 
 
-def merge_symbol_klines_csvs(symbol, csv_file_paths, output_directory):
+def iter_klines_chunks(f_path_str, engine='c', unit='ms', failed_paths=None):
+    """Typed chunks of one CSV (or zip) with times in unit; a file that cannot be read is reported and skipped.
+
+    The unit of the file is judged once, from its first chunk, and every chunk is rescaled the same way.
+    A file that fails to read, even partway, is added to failed_paths, if given, so it is not taken as merged.
+    """
+    if not Path(f_path_str).exists():
+        print(f"Warning: File not found {f_path_str}, skipping.")
+        return
+    try:
+        file_unit = None
+        for chunk in iter_klines(f_path_str, engine=engine):
+            if file_unit is None:
+                file_unit = get_time_unit(chunk['open_time'])
+                if file_unit != unit:
+                    print(f"Converting {file_unit} timestamps in {f_path_str} to {unit}")
+            yield convert_time_unit(chunk, EPOCH_COLUMNS['klines'], file_unit, unit)
+    except pd.errors.EmptyDataError:
+        print(f"Warning: Empty CSV file encountered: {f_path_str}, skipping.")
+    except Exception as e:
+        print(f"Error reading CSV {f_path_str}: {e}, skipping the rest of it.")
+        if failed_paths is not None:
+            failed_paths.add(f_path_str)
+
+
+def get_archive_start_ms(f_path_str):
+    # no row of an archive opens before 00:00 UTC of the first day in its name
+    parsed = parse_archive_name(f_path_str)
+    if parsed is None:
+        return None
+    return int(datetime.combine(parsed[3], time.min, tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def merge_symbol_klines_csvs(symbol, interval, csv_file_paths, output_directory, partitions=None, engine='c', unit='ms', trading_type='spot',
+                             memory_budget=MERGE_MEMORY_BUDGET_MB):
+    """Merges the CSVs (or zips) of one interval into the symbol's dataset under output_directory.
+
+    The files are streamed through a k-way merge and written a chunk at a time, so memory
+    grows with the number of overlapping files, not with the symbol's history.
+    partitions is the dataset's current state from the manifest; see dataset.update_dataset.
+    engine is the csv parser, 'c' or 'pyarrow'; see readers.iter_archive.
+    unit is the resolution of the times written, 'ms', or 'us' to keep what newer archives hold.
+    memory_budget (MB) sizes the runs of the external sort the merge falls back to when a file is not sorted.
+    Touches nothing but files, so it can run on a merge thread while downloads continue.
+    Returns (partitions, failed_paths): the partitions written, as (path, symbol, start_ms, end_ms, rows, interval, trading_type)
+    for the manifest, and the files that could not be read in full, which must not be taken as merged.
+    Raises DatasetUpdateError, carrying the partitions already written, when the merge fails partway.
+    """
     if not csv_file_paths:
         print(f"No CSV files provided for symbol {symbol}. Skipping merge.")
-        return
-
-    all_dfs = []
-    canonical_header = CANONICAL_KLINES_HEADERS # Directly assign the canonical headers
-    # Removed logic for determining canonical_header from files (lines 314-332)
+        return [], set()
 
+    failed_paths = set()
+    sources = []
     for f_path_str in csv_file_paths:
-        f_path = Path(f_path_str)
-        if not f_path.exists():
-            print(f"Warning: File not found {f_path_str}, skipping.")
-            continue
-        try:
-            df = pd.read_csv(f_path, header=None)
-            
-            # Fix timestamps: check if first and 7th columns have 16-digit values and convert to 13-digit
-            if not df.empty and len(df.columns) >= 7:
-                try:
-                    # Check both columns 0 (open_time) and 6 (close_time) for 16-digit timestamps
-                    first_col = df.iloc[:, 0]
-                    seventh_col = df.iloc[:, 6]
-                    
-                    # Convert to string to check length, regardless of original data type
-                    sample_first = str(first_col.dropna().iloc[0]) if len(first_col.dropna()) > 0 else ""
-                    sample_seventh = str(seventh_col.dropna().iloc[0]) if len(seventh_col.dropna()) > 0 else ""
-                    
-                    # Check if timestamps are 16 digits (need to be reduced to 13)
-                    if (len(sample_first) == 16 and sample_first.isdigit()) or (len(sample_seventh) == 16 and sample_seventh.isdigit()):
-                        print(f"Fixing 16-digit timestamps in {f_path_str} by removing last 3 digits")
-                        
-                        # Fix first column (open_time) - remove last 3 digits if 16 digits long
-                        df.iloc[:, 0] = first_col.apply(lambda x: str(int(x))[:-3] if len(str(int(x))) == 16 else str(int(x)))
-                        
-                        # Fix seventh column (close_time) - remove last 3 digits if 16 digits long
-                        df.iloc[:, 6] = seventh_col.apply(lambda x: str(int(x))[:-3] if len(str(int(x))) == 16 else str(int(x)))
-                        
-                        print(f"Fixed timestamps: {sample_first} -> {str(int(first_col.iloc[0]))[:-3] if len(str(int(first_col.iloc[0]))) == 16 else str(int(first_col.iloc[0]))}")
-                        
-                except Exception as e:
-                    print(f"Warning: Error during timestamp fix for {f_path_str}: {e}")
-            
-            df.columns = CANONICAL_KLINES_HEADERS
-            all_dfs.append(df)
-        except pd.errors.EmptyDataError:
-            print(f"Warning: Empty CSV file encountered: {f_path_str}, skipping.")
-            continue
-        except Exception as e:
-            print(f"Error reading CSV {f_path_str}: {e}, skipping.")
-            continue
-    
-    # The canonical_header is now directly assigned, so the fallback logic is simplified.
-    # We still need to ensure all_dfs is not empty before proceeding.
-    if not all_dfs:
-        print(f"No valid CSV data found to merge for symbol {symbol}.")
-        return
-    
-    processed_dfs = []
-    for i, df_to_process in enumerate(all_dfs):
-        if df_to_process.empty: # Skip empty dataframes
-            print(f"Skipping empty dataframe for {symbol} (file index {i}).")
-            continue
-        if not df_to_process.columns.equals(pd.Index(canonical_header)):
-            print(f"Re-ordering columns for a CSV for {symbol} to match canonical header.")
-            df_reordered = pd.DataFrame(columns=canonical_header)
-            for col in canonical_header:
-                if col in df_to_process.columns:
-                    df_reordered[col] = df_to_process[col]
-                else:
-                    df_reordered[col] = pd.NA 
-            processed_dfs.append(df_reordered)
-        else:
-            processed_dfs.append(df_to_process)
-    
-    if not processed_dfs:
-        print(f"No valid, non-empty CSV data left to merge for symbol {symbol} after header processing.")
-        return
-
-    merged_df = pd.concat(processed_dfs, ignore_index=True)
-
-    timestamp_column = merged_df.columns[0]
-    
-    merged_df[timestamp_column] = pd.to_numeric(merged_df[timestamp_column], errors='coerce')
-    merged_df = merged_df.dropna(subset=[timestamp_column]) # Drop rows where timestamp became NaN
-    if merged_df.empty:
-        print(f"Warning: No valid timestamp data found for symbol {symbol} after numeric conversion. Skipping merge.")
-        return
-    merged_df[timestamp_column] = pd.to_datetime(merged_df[timestamp_column], unit='ms', errors='coerce')
-    
-    # Drop rows where timestamp became NaT after datetime conversion
-    merged_df = merged_df.dropna(subset=[timestamp_column])
-    if merged_df.empty:
-        print(f"Warning: Merged DataFrame for {symbol} is empty after timestamp conversion and NaT removal. Skipping save.")
-        return
-
-    merged_df.sort_values(by=timestamp_column, inplace=True)
-    
-    merged_df.drop_duplicates(subset=[timestamp_column], keep='first', inplace=True)
-
-    # Check for empty or all NaT timestamp column before calculating min/max dates
-    if merged_df.empty or merged_df[timestamp_column].isnull().all():
-        print(f"Warning: Merged DataFrame for {symbol} is empty or timestamp column contains only NaT values. Skipping save.")
-        return
-
-    min_date_str = merged_df[timestamp_column].min().strftime('%Y%m%d')
-    max_date_str = merged_df[timestamp_column].max().strftime('%Y%m%d')
-    
-    merged_df[timestamp_column] = merged_df[timestamp_column].astype(np.int64) // 10**6
-
+        start_ms = get_archive_start_ms(f_path_str)
+        lower_bound = start_ms * TIME_UNIT_FACTORS[unit] if start_ms is not None else None
+        sources.append((lower_bound, partial(iter_klines_chunks, f_path_str, engine, unit, failed_paths)))
+    partitions = dict(partitions or {})
+    written = {}
+    rows = 0
+
+    def write(merged_chunks):
+        nonlocal rows
+        rows = 0
+        for chunk in rechunk(merged_chunks):
+            for partition in update_dataset(chunk, symbol, interval, output_directory, partitions, unit, trading_type):
+                written[partition[0]] = partition
+            rows += len(chunk)
 
-    output_filename = f"{symbol.upper()}_{min_date_str}_{max_date_str}.csv"
-    output_file_path = Path(output_directory) / output_filename
-    
     try:
-        merged_df.to_csv(output_file_path, index=False)
-        print(f"Successfully merged {len(csv_file_paths)} CSVs for {symbol} into: {output_file_path}")
-        
+        try:
+            write(merge_sorted_chunks(sources, 'open_time'))
+        except UnsortedSourceError as e:
+            # Overlapping or re-issued files can break the order the streaming merge relies on. Every file is
+            # read again; the rows already written come back as late data and replace themselves.
+            print(f"Warning: {e} for {symbol} {interval}. Merging again with an external sort ({memory_budget} MB runs).")
+            failed_paths.clear()
+            chunks = chain.from_iterable(open_chunks() for _, open_chunks in sources)
+            write(external_sort(chunks, 'open_time', memory_budget * 1024 * 1024, output_directory))
     except Exception as e:
-        print(f"Error saving merged CSV for {symbol} to {output_file_path}: {e}")
+        if isinstance(e, DatasetUpdateError):
+            for partition in e.partitions:
+                written[partition[0]] = partition
+        raise DatasetUpdateError(f"Error saving merged {interval} data for {symbol}: {e}", list(written.values())) from e
+
+    if not rows:
+        print(f"No valid CSV data found to merge for symbol {symbol}.")
+        return [], failed_paths
+    print(f"Successfully merged {len(csv_file_paths) - len(failed_paths)} CSVs ({rows} rows) for {symbol} {interval} into {len(written)} partitions")
+    return list(written.values()), failed_paths
 
 
 if __name__ == "__main__":
     parser = get_parser('klines')
+    parser.add_argument(
+        '-adaptive', dest='adaptive', default=1, type=int, choices=[0, 1],
+        help='1 to tune the number of downloads in flight at runtime, using -max-in-flight as the ceiling; 0 to keep it fixed, default 1')
+    parser.add_argument(
+        '-use-listing', dest='use_listing', default=1, type=int, choices=[0, 1],
+        help='1 to list each symbol/interval prefix in the bucket once and only request archives that exist, default 1')
+    parser.add_argument(
+        '-retry-failed', dest='retry_failed',
+        help='Only re-run the requests recorded in this failures file by an earlier run, e.g. {}/{}'.format(DEFAULT_OUTPUT_FOLDER, FAILED_DOWNLOADS_FILE))
+    parser.add_argument(
+        '-cpu-workers', dest='cpu_workers', default=CPU_WORKERS, type=int,
+        help='Number of threads that unzip downloaded archives while the network keeps downloading, default {}'.format(CPU_WORKERS))
+    parser.add_argument(
+        '-keep-csv', dest='keep_csv', default=1, type=int, choices=[0, 1],
+        help='1 to extract every archive to a CSV next to it; 0 to keep only the zips and parse them in memory when merging, default 1')
+    parser.add_argument(
+        '-active-only', dest='active_only', default=0, type=int, choices=[0, 1],
+        help='1 to skip symbols that exchangeInfo does not list as trading, default 0')
+    parser.add_argument(
+        '-quote-asset', dest='quote_assets', nargs='+',
+        help='Only download symbols quoted in these assets, e.g. -quote-asset USDT FDUSD')
+    parser.add_argument(
+        '-revalidate', dest='revalidate', default=0, type=int, choices=[0, 1],
+        help='1 to send a conditional request for every archive already downloaded, re-download the ones that changed\nand rebuild the merged outputs that cover them, default 0')
+    parser.add_argument(
+        '-merge-workers', dest='merge_workers', default=MERGE_WORKERS, type=int,
+        help='Number of threads that merge a symbol as soon as its last archive is downloaded, default {}'.format(MERGE_WORKERS))
+    parser.add_argument(
+        '-engine', dest='engine', default='c', choices=ENGINES,
+        help='CSV parser for merging: c (pandas) or pyarrow (multithreaded, needs pyarrow installed), default c')
+    parser.add_argument(
+        '-timestamp-unit', dest='timestamp_unit', default='ms', choices=TIME_UNITS,
+        help='Resolution of open_time/close_time in merged datasets: ms, or us to keep the microseconds of archives since 2025, default ms.\n'
+             'Archives in either unit are converted; pick one per dataset')
+    parser.add_argument(
+        '-memory-budget', dest='memory_budget', default=MERGE_MEMORY_BUDGET_MB, type=int,
+        help='Size in MB of the sorted runs spilled to the folder when a merge meets overlapping or unsorted archives, default {}'.format(MERGE_MEMORY_BUDGET_MB))
     args = parser.parse_args(sys.argv[1:])
+    if args.engine == 'pyarrow':
+        try:
+            import pyarrow
+        except ImportError:
+            parser.error("-engine pyarrow needs pyarrow installed, e.g. pip install pyarrow")
 
     if args.folder is None:
         args.folder = DEFAULT_OUTPUT_FOLDER
     Path(args.folder).mkdir(parents=True, exist_ok=True)
     print(f"Using output folder: {args.folder}")
-
-    if not args.symbols:
-      print("fetching all symbols from exchange")
-      symbols = get_all_symbols(args.type)
+    manifest = Manifest(args.folder)
+
+    failed_requests = None
+    first_dates = {}
+    failures_path = os.path.join(args.folder, FAILED_DOWNLOADS_FILE)
+    if args.retry_failed:
+        failed_requests = load_failed_requests(args.retry_failed)
+        print(f"Loaded {len(failed_requests)} failed requests from {args.retry_failed}")
+    if os.path.exists(failures_path):
+        # This run records its own failures
+        os.remove(failures_path)
+
+    if failed_requests is not None:
+      symbols = sorted({req.symbol for req in failed_requests})
       num_symbols = len(symbols)
     else:
-      symbols = args.symbols
+      catalogue = {}
+      try:
+        catalogue = get_symbol_catalogue(args.type, args.folder)
+      except Exception as e:
+        if not args.symbols:
+          raise
+        print(f"Warning: could not load exchangeInfo ({e}). Planning without listing dates.")
+      if not args.symbols:
+        print("fetching all symbols from exchange")
+        symbols = list(catalogue)
+      else:
+        symbols = args.symbols
+      symbols = filter_symbols(catalogue, symbols, args.active_only, args.quote_assets)
       num_symbols = len(symbols)
+      first_dates = {symbol: convert_to_date_object(info['onboardDate']) for symbol, info in catalogue.items() if info.get('onboardDate')}
 
     if args.dates:
       dates = args.dates
@@ -455,27 +601,97 @@ if __name__ == "__main__":
           print("Warning: PERIOD_START_DATE not found in enums.py, using default '2017-01-01'.")
           PERIOD_START_DATE = "2017-01-01"
       
-      period = convert_to_date_object(datetime.today().strftime('%Y-%m-%d')) - convert_to_date_object(
-        PERIOD_START_DATE)
-      dates = pd.date_range(end=datetime.today(), periods=period.days + 1).to_pydatetime().tolist()
-      dates = [date.strftime("%Y-%m-%d") for date in dates]
+      # every day from PERIOD_START_DATE through today, as a datetime64 array
+      dates = np.arange(np.datetime64(PERIOD_START_DATE, 'D'), np.datetime64(datetime.today().date(), 'D') + 1)
 
     all_extracted_csvs = {}
 
-    if args.skip_monthly == 0:
-      monthly_csvs = download_monthly_klines(args.type, symbols, num_symbols, args.intervals, args.years, args.months, args.startDate, args.endDate, args.folder, args.checksum)
+    if failed_requests:
+        download_requests(failed_requests, "previously failed", args.max_in_flight, all_extracted_csvs, args.folder, args.adaptive, manifest, keep_csv=args.keep_csv, cpu_workers=args.cpu_workers)
+
+    if args.revalidate == 1 and failed_requests is None:
+      revalidated_csvs = revalidate_klines(symbols, args.max_in_flight, args.folder, args.adaptive, manifest, args.keep_csv, args.cpu_workers, args.type)
+      for symbol, paths in revalidated_csvs.items():
+          if symbol not in all_extracted_csvs:
+              all_extracted_csvs[symbol] = []
+          all_extracted_csvs[symbol].extend(paths)
+
+    first_months = manifest.first_archive_months()
+    if args.use_listing == 0 and failed_requests is None:
+      # Without a bucket listing, find where each symbol/interval starts instead of probing every month since START_DATE
+      monthly_prefixes = [get_path(args.type, "klines", "monthly", symbol, interval) for symbol in symbols for interval in args.intervals]
+      undiscovered = [prefix for prefix in monthly_prefixes if prefix not in first_months]
+      if undiscovered:
+        last_month = np.datetime64(convert_to_date_object(args.endDate) if args.endDate else END_DATE, 'M')
+        published_months = np.datetime_as_string(np.arange(np.datetime64(START_DATE, 'M'), last_month + 1), unit='M').tolist()
+        discovered = discover_first_months(undiscovered, published_months, args.max_in_flight)
+        manifest.record_first_archive_months(discovered)
+        first_months.update(discovered)
+
+    # Months the monthly archives cover, so the daily run only fills the gaps
+    coverage = set()
+
+    # A symbol is merged on a merge thread as soon as the last phase has finished all of its requests,
+    # instead of after every symbol is downloaded. Manifest reads and writes stay on this thread.
+    merge_pool = ThreadPoolExecutor(max_workers=max(1, args.merge_workers))
+    merge_futures = {}
+    dispatched_symbols = set()
+    dispatched_merges = []
+
+    def record_merge(symbol_files, merge):
+        # merge() returns the partitions written and the files it could not read in full; a failed merge
+        # still reports the partitions it wrote, but its inputs stay unmerged so the next run merges them again
+        try:
+            partitions, failed_paths = merge()
+        except DatasetUpdateError as e:
+            print(e)
+            for partition in e.partitions:
+                manifest.record_merged_output(*partition)
+            return
+        for partition in partitions:
+            manifest.record_merged_output(*partition)
+        if partitions:
+            manifest.record_dataset_inputs_merged([path for path in symbol_files if path not in failed_paths])
+
+    def record_finished_merges():
+        # Record every merge that has finished as soon as this thread gets to it, so an interrupted
+        # run never leaves partitions on disk that the manifest does not know about
+        for future in [future for future in merge_futures if future.done()]:
+            record_merge(merge_futures.pop(future), future.result)
+
+    def dispatch_merge(symbol):
+        dispatched_symbols.add(symbol)
+        for interval in manifest.archive_intervals(symbol, args.type):
+            symbol_files = manifest.dataset_inputs(symbol, interval, args.type)
+            if symbol_files:
+                print(f"All archives for {symbol} are in. Merging {len(symbol_files)} {interval} files while the downloads continue")
+                dispatched_merges.append((symbol, interval))
+                merge_futures[merge_pool.submit(merge_symbol_klines_csvs, symbol, interval, symbol_files, args.folder,
+                                                manifest.dataset_partitions(symbol, interval, args.type), args.engine, args.timestamp_unit,
+                                                args.type, args.memory_budget)] = symbol_files
+
+    tracker = CompletionTracker(dispatch_merge, record_finished_merges) if failed_requests is None else None
+    monthly_tracker = tracker if args.skip_daily == 1 else None
+    daily_tracker = tracker if args.skip_daily == 0 else None
+
+    if args.skip_monthly == 0 and failed_requests is None:
+      monthly_csvs = download_monthly_klines(args.type, symbols, num_symbols, args.intervals, args.years, args.months, args.startDate, args.endDate, args.folder, args.checksum, args.max_in_flight, args.adaptive, args.use_listing, manifest, coverage, first_dates, first_months, args.keep_csv, args.cpu_workers, monthly_tracker)
       for symbol, paths in monthly_csvs.items():
           if symbol not in all_extracted_csvs:
               all_extracted_csvs[symbol] = []
           all_extracted_csvs[symbol].extend(paths)
 
-    if args.skip_daily == 0:
-      daily_csvs = download_daily_klines(args.type, symbols, num_symbols, args.intervals, dates, args.startDate, args.endDate, args.folder, args.checksum)
+    if args.skip_daily == 0 and failed_requests is None:
+      daily_csvs = download_daily_klines(args.type, symbols, num_symbols, args.intervals, dates, args.startDate, args.endDate, args.folder, args.checksum, args.max_in_flight, args.adaptive, args.use_listing, manifest, coverage, first_dates, first_months, args.keep_csv, args.cpu_workers, daily_tracker)
       for symbol, paths in daily_csvs.items():
           if symbol not in all_extracted_csvs:
               all_extracted_csvs[symbol] = []
           all_extracted_csvs[symbol].extend(paths)
 
+    for future in as_completed(list(merge_futures)):
+        record_merge(merge_futures.pop(future), future.result)
+    merge_pool.shutdown()
+
     # Debug: Check what files are available for merging
     print(f"\nDebug: all_extracted_csvs contains: {all_extracted_csvs}")
     
@@ -485,86 +701,28 @@ if __name__ == "__main__":
     # Add any symbols that had extracted files
     if all_extracted_csvs:
         all_symbols_to_merge.update(all_extracted_csvs.keys())
+    # Symbols already merged while downloading
+    all_symbols_to_merge -= dispatched_symbols
     
     print(f"Debug: Symbols to check for merging: {all_symbols_to_merge}")
     
     symbols_with_files_to_merge = {}
     
     for symbol in all_symbols_to_merge:
-        symbol_files = []
-        
-        # Add newly extracted files
-        if symbol in all_extracted_csvs:
-            symbol_files.extend(all_extracted_csvs[symbol])
-            print(f"Debug: {symbol} - Added {len(all_extracted_csvs[symbol])} newly extracted files")
-        
-        # Also collect any existing individual CSV files that haven't been merged
-        # Look in the data directory structure for this symbol
-        data_pattern_monthly = f"{args.folder}/data/spot/monthly/klines/{symbol.upper()}/*/{symbol.upper()}-*-*-*.csv"
-        data_pattern_daily = f"{args.folder}/data/spot/daily/klines/{symbol.upper()}/*/{symbol.upper()}-*-*-*-*.csv"
-        
-        import glob
-        print(f"Debug: {symbol} - Checking monthly pattern: {data_pattern_monthly}")
-        print(f"Debug: {symbol} - Checking daily pattern: {data_pattern_daily}")
-        
-        existing_monthly_files = glob.glob(data_pattern_monthly)
-        existing_daily_files = glob.glob(data_pattern_daily)
-        
-        print(f"Debug: {symbol} - Monthly files found: {existing_monthly_files}")
-        print(f"Debug: {symbol} - Daily files found: {existing_daily_files}")
-        
-        all_existing_files = existing_monthly_files + existing_daily_files
-        print(f"Debug: {symbol} - Found {len(all_existing_files)} existing individual CSV files")
-        
-        # Filter out files that are already covered by existing merged files
-        # Get the latest merged file end date for this symbol
-        output_folder_path = Path(args.folder)
-        merged_file_pattern = f"{symbol.upper()}_*_*.csv"
-        latest_merged_end_date = None
-        
-        for merged_file in output_folder_path.glob(merged_file_pattern):
-            try:
-                symbol_prefix_in_filename = symbol.upper() + "_"
-                if not merged_file.stem.startswith(symbol_prefix_in_filename):
-                    continue
-                dates_section = merged_file.stem[len(symbol_prefix_in_filename):]
-                date_strings = dates_section.split('_')
-                if len(date_strings) == 2:
-                    end_date_str_from_file = date_strings[1]
-                    parsed_end_date = datetime.strptime(end_date_str_from_file, "%Y%m%d").date()
-                    if latest_merged_end_date is None or parsed_end_date > latest_merged_end_date:
-                        latest_merged_end_date = parsed_end_date
-            except:
-                continue
-        
-        print(f"Debug: {symbol} - Latest merged end date: {latest_merged_end_date}")
-        
-        # Only include files that are after the latest merged date
-        if latest_merged_end_date:
-            filtered_files = []
-            for file_path in all_existing_files:
-                try:
-                    file_date = parse_date_from_filename(file_path)
-                    if file_date > latest_merged_end_date:
-                        filtered_files.append(file_path)
-                        print(f"Debug: {symbol} - Including file {file_path} (date: {file_date})")
-                    else:
-                        print(f"Debug: {symbol} - Skipping file {file_path} (date: {file_date}) - already merged")
-                except:
-                    print(f"Debug: {symbol} - Could not parse date from {file_path}")
-            symbol_files.extend(filtered_files)
-        else:
-            symbol_files.extend(all_existing_files)
-            print(f"Debug: {symbol} - No existing merged file, including all {len(all_existing_files)} individual files")
-        
-        if symbol_files:
-            symbols_with_files_to_merge[symbol] = symbol_files
-            print(f"Debug: {symbol} - Total files to merge: {len(symbol_files)}")
+        # Every extracted file in the manifest that the symbol's datasets have not taken in yet,
+        # whether it was downloaded in this run or left over from an earlier one
+        for interval in manifest.archive_intervals(symbol, args.type):
+            symbol_files = manifest.dataset_inputs(symbol, interval, args.type)
+            print(f"Debug: {symbol} {interval} - {len(symbol_files)} files to merge")
+            
+            if symbol_files:
+                symbols_with_files_to_merge[(symbol, interval)] = symbol_files
     
     if symbols_with_files_to_merge:
-        print(f"\nStarting CSV merging process for {len(symbols_with_files_to_merge)} symbols...")
-        for symbol, csv_paths in symbols_with_files_to_merge.items():
-            print(f"Merging {len(csv_paths)} files for symbol {symbol}")
-            merge_symbol_klines_csvs(symbol, csv_paths, args.folder)
-    else:
-        print("No files found to merge.")
\ No newline at end of file
+        print(f"\nStarting CSV merging process for {len(symbols_with_files_to_merge)} symbol intervals...")
+        for (symbol, interval), csv_paths in symbols_with_files_to_merge.items():
+            print(f"Merging {len(csv_paths)} {interval} files for symbol {symbol}")
+            record_merge(csv_paths, partial(merge_symbol_klines_csvs, symbol, interval, csv_paths, args.folder, manifest.dataset_partitions(symbol, interval, args.type), args.engine, args.timestamp_unit, args.type, args.memory_budget))
+    elif not dispatched_merges:
+        print("No files found to merge.")
+    manifest.close()
\ No newline at end of file
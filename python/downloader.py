@@ -0,0 +1,335 @@
+"""
+  download engine shared by the kline downloaders.
+
+  keeps up to max_in_flight requests running at once and starts the next
+  planned request as soon as any of them finishes, so one slow archive never
+  holds back the rest of the queue. bodies are streamed to disk by the worker
+  that fetched them, so memory use stays at max_in_flight blocks no matter
+  how large the archives are, and an interrupted archive resumes from its
+  .part file on the next run.
+
+  archives are hashed as they stream and checked against their .CHECKSUM;
+  a corrupt one is quarantined and retried like any other transient failure.
+
+  transient failures (connection errors, timeouts, 429 and 5xx) go back into
+  the queue with exponential backoff and full jitter. 404s are final. requests
+  that still fail are appended to a json-lines file that a later run can feed
+  straight back into run_downloads with load_failed_requests.
+
+  with an AdaptiveConcurrency controller the in-flight limit is no longer
+  fixed: it grows additively while requests succeed and shrinks
+  multiplicatively on throttling, connection errors or rising latency, up to
+  max_in_flight as a ceiling. latency is the time to the response headers,
+  so it does not grow with archive size, and a corrupt archive says nothing
+  about congestion, so it is retried without touching the limit.
+
+  unzipping and parsing can run on a separate pool of cpu workers, fed through
+  a bounded queue, so the dispatch loop keeps the network busy meanwhile.
+
+  a plan is any iterable of PlannedRequest, typically a generator, so the
+  engine starts downloading while the rest of the plan is still being built.
+
+"""
+import heapq
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timezone
+from itertools import count, islice
+
+import requests
+
+from enums import MAX_IN_FLIGHT, CPU_WORKERS, MAX_RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY, AIMD_INITIAL_LIMIT, \
+  AIMD_DECREASE_FACTOR, AIMD_LATENCY_TOLERANCE, AIMD_LATENCY_DECREASE_FACTOR
+from utility import get_session, fetch_to_file, CorruptArchiveError
+
+
+class AdaptiveConcurrency:
+  """AIMD controller for the number of requests in flight.
+
+  Completions are grouped into windows of `limit` requests, roughly one round
+  trip of the whole pipeline. A clean window raises the limit by one. The first
+  throttling or connection error in a window cuts it by AIMD_DECREASE_FACTOR.
+  A window whose mean latency is over AIMD_LATENCY_TOLERANCE times the best
+  seen, with no gain in throughput over the previous window, cuts it by
+  AIMD_LATENCY_DECREASE_FACTOR.
+  """
+
+  def __init__(self, ceiling, initial=AIMD_INITIAL_LIMIT, floor=1):
+    self.floor = floor
+    self.ceiling = max(floor, ceiling)
+    self.limit = float(min(max(initial, floor), self.ceiling))
+    self.best_latency = None
+    self.last_throughput = None
+    self._start_window()
+
+  @property
+  def in_flight_limit(self):
+    return int(self.limit)
+
+  def _start_window(self):
+    self.window_started = time.monotonic()
+    self.window_completed = 0
+    self.window_latency = 0.0
+    self.window_samples = 0
+    self.window_bytes = 0
+    self.window_failed = False
+
+  def on_success(self, latency, nbytes):
+    # only requests that moved a body count towards latency and throughput
+    if nbytes:
+      self.window_latency += latency
+      self.window_samples += 1
+      self.window_bytes += nbytes
+    self._complete()
+
+  def on_failure(self):
+    if not self.window_failed:
+      self.window_failed = True
+      self._set_limit(self.limit * AIMD_DECREASE_FACTOR)
+    self._complete()
+
+  def _complete(self):
+    self.window_completed += 1
+    if self.window_completed >= self.in_flight_limit:
+      self._end_window()
+
+  def _end_window(self):
+    throughput = self.window_bytes / max(time.monotonic() - self.window_started, 1e-6)
+    if not self.window_failed:
+      latency = self.window_latency / self.window_samples if self.window_samples else None
+      if latency is not None and (self.best_latency is None or latency < self.best_latency):
+        self.best_latency = latency
+      congested = latency is not None and latency > AIMD_LATENCY_TOLERANCE * self.best_latency and \
+        self.last_throughput is not None and throughput <= self.last_throughput
+      if congested:
+        self._set_limit(self.limit * AIMD_LATENCY_DECREASE_FACTOR)
+      else:
+        self._set_limit(self.limit + 1)
+    self.last_throughput = throughput
+    self._start_window()
+
+  def _set_limit(self, limit):
+    previous = self.in_flight_limit
+    self.limit = min(self.ceiling, max(self.floor, limit))
+    if self.in_flight_limit != previous:
+      print(f"Adjusted in-flight limit: {previous} -> {self.in_flight_limit}")
+
+
+class PlannedRequest:
+  """One planned GET. Slotted, since a full plan runs to millions of them.
+
+  An archive with a checksum_url is verified against that .CHECKSUM as it downloads.
+  """
+
+  __slots__ = ('url', 'destination_path', 'symbol', 'interval', 'is_checksum', 'etag', 'last_modified', 'checksum_url')
+  method = 'GET'
+
+  def __init__(self, url, destination_path, symbol=None, interval=None, is_checksum=False, etag=None, last_modified=None,
+               checksum_url=None):
+    self.url = url
+    self.destination_path = destination_path
+    self.symbol = symbol
+    self.interval = interval
+    self.is_checksum = is_checksum
+    self.etag = etag
+    self.last_modified = last_modified
+    self.checksum_url = checksum_url
+
+  @property
+  def params(self):
+    return {name: getattr(self, name) for name in self.__slots__[1:]}
+
+
+class CompletionTracker:
+  """Calls on_complete(key) as soon as every request planned for key has finished.
+
+  The planner calls planned(key) for each request it yields and close(key)
+  once it will plan no more for key; the response handler calls
+  finished(key). All three are meant to be called from the dispatch thread.
+  on_finished(), if given, is called after every finished request, so work
+  done on other threads can be collected on the dispatch thread as it goes.
+  """
+
+  def __init__(self, on_complete, on_finished=None):
+    self.on_complete = on_complete
+    self.on_finished = on_finished
+    self.outstanding = {}
+    self.closed = set()
+    self.completed = set()
+
+  def planned(self, key):
+    self.outstanding[key] = self.outstanding.get(key, 0) + 1
+
+  def finished(self, key):
+    if key in self.outstanding:
+      self.outstanding[key] -= 1
+      self._check(key)
+    if self.on_finished is not None:
+      self.on_finished()
+
+  def close(self, key):
+    self.closed.add(key)
+    self._check(key)
+
+  def _check(self, key):
+    if key in self.closed and not self.outstanding.get(key) and key not in self.completed:
+      self.completed.add(key)
+      self.on_complete(key)
+
+
+def fetch(session, request):
+  """(response, seconds to its headers); the body has already been streamed to disk."""
+  response = fetch_to_file(session, request.url, request.destination_path,
+                           etag=request.etag, last_modified=request.last_modified, checksum_url=request.checksum_url)
+  return response, response.elapsed.total_seconds()
+
+def is_transient_failure(response):
+  if response is None:
+    return True
+  return response.status_code == 429 or response.status_code >= 500
+
+def get_retry_delay(attempt):
+  return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+def record_failed_request(failures_path, request, response, error, attempts):
+  record = {
+    'url': request.url,
+    'method': request.method,
+    'params': request.params,
+    'status': response.status_code if response is not None else None,
+    'error': error,
+    'attempts': attempts,
+    'failed_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+  }
+  with open(failures_path, 'a') as f:
+    f.write(json.dumps(record) + '\n')
+
+def load_failed_requests(failures_path):
+  """Reads the requests recorded by an earlier run back into planned requests for run_downloads."""
+  failed_requests = []
+  with open(failures_path) as f:
+    for line in f:
+      if line.strip():
+        record = json.loads(line)
+        failed_requests.append(PlannedRequest(record['url'], **record['params']))
+  return failed_requests
+
+def run_downloads(planned_requests, handle_response, max_in_flight=MAX_IN_FLIGHT, failures_path=None, controller=None,
+                  process_response=None, cpu_workers=CPU_WORKERS, queue_size=None):
+  """Downloads every planned request, calling handle_response(request, response) as each one completes.
+
+  planned_requests can be any iterable of PlannedRequest; it is consumed lazily,
+  only as fast as slots free up. A successful body is already on disk at
+  destination_path when handle_response runs. Requests that carry the etag /
+  last_modified of an earlier download are conditional and complete with a 304
+  when nothing changed. handle_response only sees the final outcome of a request, after any
+  retries; response is None when it failed before it could be completed.
+  Requests that failed for good, other than 404s, are appended to failures_path.
+  When an AdaptiveConcurrency controller is given it sets the in-flight limit,
+  with max_in_flight as the ceiling.
+
+  With process_response the work is pipelined in three stages: max_in_flight
+  network workers, then process_response(request, response) for every
+  successful response on a pool of cpu_workers threads (unzipping, parsing),
+  then handle_response(request, response, result) back on the calling thread,
+  which is the only one that should write shared state. A request that
+  process_response fails on reaches handle_response with no response, as a
+  network failure does. At most queue_size responses (default max_in_flight +
+  2 * cpu_workers) are in flight, wait for or sit in the CPU stage; while that
+  many are out no new requests are started.
+  """
+  max_in_flight = max(1, int(max_in_flight))
+  cpu_workers = max(1, int(cpu_workers))
+  queue_size = max(1, int(queue_size or max_in_flight + 2 * cpu_workers))
+  session = get_session(max_in_flight)
+  pending = iter(planned_requests)
+  in_flight = {}
+  processing = {}
+  retry_queue = []
+  attempts = {}
+  sequence = count()
+
+  def submit(pool, request):
+    in_flight[pool.submit(fetch, session, request)] = request
+
+  with ThreadPoolExecutor(max_workers=max_in_flight) as pool, ThreadPoolExecutor(max_workers=cpu_workers) as cpu_pool:
+    while True:
+      limit = min(max_in_flight, controller.in_flight_limit) if controller else max_in_flight
+      # backpressure: every response in flight is headed for the CPU stage too, so stop fetching while it is behind
+      if process_response:
+        limit = min(limit, max(0, queue_size - len(processing)))
+      now = time.monotonic()
+      while retry_queue and retry_queue[0][0] <= now and len(in_flight) < limit:
+        submit(pool, heapq.heappop(retry_queue)[2])
+      for request in islice(pending, max(0, limit - len(in_flight))):
+        submit(pool, request)
+      if not in_flight and not retry_queue and not processing:
+        break
+
+      timeout = None
+      if retry_queue and len(in_flight) < limit:
+        timeout = max(0, retry_queue[0][0] - now)
+      if not in_flight and not processing:
+        time.sleep(timeout)
+        continue
+
+      done, _ = wait(list(in_flight) + list(processing), timeout=timeout, return_when=FIRST_COMPLETED)
+      for future in done:
+        if future in processing:
+          request, response = processing.pop(future)
+          try:
+            result = future.result()
+          except Exception as e:
+            print(f"Error processing {request.url}: {e}")
+            if failures_path:
+              record_failed_request(failures_path, request, response, str(e), 1)
+            handle_response(request, None, None)
+            continue
+          handle_response(request, response, result)
+          continue
+
+        request = in_flight.pop(future)
+        error = None
+        corrupt = False
+        try:
+          response, latency = future.result()
+        except (requests.RequestException, OSError) as e:
+          error = str(e)
+          response = None
+          corrupt = isinstance(e, CorruptArchiveError)
+
+        if controller and not corrupt:
+          if is_transient_failure(response):
+            controller.on_failure()
+          else:
+            nbytes = int(response.headers.get('content-length') or 0) if response.ok else 0
+            controller.on_success(latency, nbytes)
+
+        if response is not None and response.ok:
+          attempts.pop(request.url, None)
+          if process_response:
+            processing[cpu_pool.submit(process_response, request, response)] = (request, response)
+          else:
+            handle_response(request, response)
+          continue
+
+        attempt = attempts.get(request.url, 0) + 1
+        if is_transient_failure(response) and attempt <= MAX_RETRIES:
+          attempts[request.url] = attempt
+          delay = get_retry_delay(attempt)
+          reason = error if error else f"HTTP {response.status_code}"
+          print(f"Retrying {request.url} in {delay:.1f}s ({reason}, retry {attempt}/{MAX_RETRIES})")
+          heapq.heappush(retry_queue, (time.monotonic() + delay, next(sequence), request))
+          continue
+
+        attempts.pop(request.url, None)
+        if error:
+          print(f"Request error for {request.url}: {error}")
+        if failures_path and (response is None or response.status_code != 404):
+          record_failed_request(failures_path, request, response, error, attempt)
+        if process_response:
+          handle_response(request, response, None)
+        else:
+          handle_response(request, response)
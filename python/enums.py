@@ -1,3 +1,4 @@
+import os
 from datetime import *
 
 YEARS = ['2017', '2018', '2019', '2020', '2021', '2022', '2023', '2024', '2025']
@@ -7,5 +8,29 @@ TRADING_TYPE = ["spot", "um", "cm"]
 MONTHS = list(range(1,13))
 PERIOD_START_DATE = '2020-01-01'
 BASE_URL = 'https://data.binance.vision/'
+LISTING_URL = 'https://s3-ap-northeast-1.amazonaws.com/data.binance.vision'
 START_DATE = date(int(YEARS[0]), MONTHS[0], 1)
 END_DATE = datetime.date(datetime.now())
+MAX_IN_FLIGHT = 64
+LISTING_PREFETCH = 4
+CPU_WORKERS = os.cpu_count() or 1
+MERGE_WORKERS = 2
+REQUEST_TIMEOUT = 60
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+QUARANTINE_SUFFIX = '.corrupt'
+MERGED_FOLDER = 'merged'
+MERGE_CHUNK_ROWS = 100000
+MERGE_MEMORY_BUDGET_MB = 1024
+SPILL_CHUNK_ROWS = 10000
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 60
+AIMD_INITIAL_LIMIT = 8
+AIMD_DECREASE_FACTOR = 0.5
+AIMD_LATENCY_TOLERANCE = 2.0
+AIMD_LATENCY_DECREASE_FACTOR = 0.9
+MISSING_RECENT_DAYS = 7
+MISSING_RECENT_TTL = timedelta(hours=6)
+MISSING_PERMANENT_AFTER_DAYS = 90
+MISSING_TTL = timedelta(days=7)
+EXCHANGE_INFO_TTL = timedelta(hours=24)
@@ -0,0 +1,460 @@
+"""
+  local manifest of downloaded archives and merged outputs.
+
+  every archive the kline downloader fetches is recorded with its url, size,
+  etag, checksum, extracted csv path and the date range it covers, and every
+  merged output with its row range. planning and merging then look things up
+  in an indexed sqlite table instead of globbing the store and parsing file
+  names.
+
+  the stored etag and last-modified values make re-downloads conditional. an
+  archive that comes back with a different etag or checksum marks every merged
+  output overlapping its date range stale, and the next merge rebuilds them.
+
+  only klines are tracked. archives and merged outputs are keyed by trading
+  type too, so spot and futures klines of a symbol kept in one folder stay
+  apart. merged outputs are the monthly partitions of the per trading type,
+  symbol and interval datasets (see dataset.py), and each archive remembers whether a dataset has
+  taken it in, so a merge only reads the archives it has not seen yet.
+
+  the first monthly archive found for each prefix is kept for good, and
+  urls that answered 404 are remembered too, for a time that depends on how
+  old the period is, so planners can skip them without a request.
+
+  a store created before the manifest existed is imported once, the first
+  time the manifest is opened.
+
+  paths inside the store are kept relative to its folder, so the manifest
+  works from any working directory and after the store is moved. they are
+  handed back absolute.
+
+"""
+import os
+import re
+import sqlite3
+from calendar import monthrange
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+
+from enums import MISSING_RECENT_DAYS, MISSING_RECENT_TTL, MISSING_PERMANENT_AFTER_DAYS, MISSING_TTL
+from utility import get_download_url
+
+MANIFEST_FILE = "manifest.sqlite3"
+# PRAGMA user_version from which paths are stored relative to the manifest folder,
+# and from which only klines are kept, with their trading type
+RELATIVE_PATHS_VERSION = 1
+TRADING_TYPES_VERSION = 2
+
+ARCHIVE_NAME_PATTERN = re.compile(r'^(?P<symbol>[A-Z0-9]+)-(?P<interval>\w+)-(?P<year>\d{4})-(?P<month>\d{2})(?:-(?P<day>\d{2}))?\.(?:csv|zip)$')
+# data/<spot|futures/um|futures/cm>/<daily|monthly>/<data type>/ in a bucket url or a store path
+ARCHIVE_PATH_PATTERN = re.compile(r'(?:^|/)data/(?:spot|futures/(?P<futures>um|cm))/(?:daily|monthly)/(?P<data_type>\w+)/')
+MERGED_NAME_PATTERN = re.compile(r'^(?P<symbol>[A-Z0-9]+)_(?P<start>\d{8})_(?P<end>\d{8})\.csv$')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+  url TEXT PRIMARY KEY,
+  trading_type TEXT,
+  symbol TEXT NOT NULL,
+  interval TEXT,
+  period TEXT NOT NULL,
+  start_date TEXT NOT NULL,
+  end_date TEXT NOT NULL,
+  path TEXT,
+  extracted_path TEXT,
+  size INTEGER,
+  etag TEXT,
+  last_modified TEXT,
+  checksum TEXT,
+  downloaded_at TEXT,
+  merged INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS archives_by_symbol ON archives (symbol, end_date);
+CREATE TABLE IF NOT EXISTS merged_outputs (
+  path TEXT PRIMARY KEY,
+  symbol TEXT NOT NULL,
+  start_date TEXT NOT NULL,
+  end_date TEXT NOT NULL,
+  start_time INTEGER,
+  end_time INTEGER,
+  rows INTEGER,
+  created_at TEXT,
+  stale INTEGER NOT NULL DEFAULT 0,
+  interval TEXT,
+  superseded INTEGER NOT NULL DEFAULT 0,
+  trading_type TEXT
+);
+CREATE INDEX IF NOT EXISTS merged_outputs_by_symbol ON merged_outputs (symbol, end_date);
+CREATE TABLE IF NOT EXISTS first_archives (
+  prefix TEXT PRIMARY KEY,
+  first_month TEXT NOT NULL,
+  discovered_at TEXT
+);
+CREATE TABLE IF NOT EXISTS missing_archives (
+  url TEXT PRIMARY KEY,
+  end_date TEXT,
+  checked_at TEXT NOT NULL,
+  expires_at TEXT
+);
+"""
+
+
+def parse_archive_name(file_name):
+  """Returns (symbol, interval, period, start_date, end_date) for an archive or extracted csv name, or None."""
+  match = ARCHIVE_NAME_PATTERN.match(os.path.basename(file_name))
+  if not match:
+    return None
+  year, month = int(match.group('year')), int(match.group('month'))
+  if match.group('day'):
+    day = date(year, month, int(match.group('day')))
+    return match.group('symbol'), match.group('interval'), 'daily', day, day
+  return match.group('symbol'), match.group('interval'), 'monthly', \
+    date(year, month, 1), date(year, month, monthrange(year, month)[1])
+
+def parse_archive_path(path):
+  """(trading type, data type) of an archive from its bucket url or store path, e.g. ('um', 'klines'), or None."""
+  match = ARCHIVE_PATH_PATTERN.search(str(path).replace(os.sep, '/'))
+  if not match:
+    return None
+  return match.group('futures') or 'spot', match.group('data_type')
+
+def _is_klines_path(path):
+  kind = parse_archive_path(path)
+  return kind is not None and kind[1] == 'klines'
+
+def _trading_type_filter(trading_type, column='trading_type'):
+  # no trading type matches them all
+  if trading_type is None:
+    return "", []
+  return f" AND {column} = ?", [trading_type]
+
+def _now():
+  return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+def get_missing_ttl(end_date, today=None):
+  """How long a 404 for a period ending on end_date stays cached; None means for good.
+
+  Archives for the last few days may still be published, so those are
+  rechecked within hours. A period older than MISSING_PERMANENT_AFTER_DAYS
+  that is still missing is never going to appear.
+  """
+  age = ((today or datetime.now(timezone.utc).date()) - end_date).days
+  if age <= MISSING_RECENT_DAYS:
+    return MISSING_RECENT_TTL
+  if age <= MISSING_PERMANENT_AFTER_DAYS:
+    return MISSING_TTL
+  return None
+
+
+class Manifest:
+  """Embedded sqlite manifest kept at <folder>/manifest.sqlite3."""
+
+  def __init__(self, folder):
+    self.folder = folder
+    self.root = os.path.abspath(folder)
+    self.path = os.path.join(folder, MANIFEST_FILE)
+    is_new = not os.path.exists(self.path)
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    self.connection = sqlite3.connect(self.path)
+    self.connection.executescript(SCHEMA)
+    self._add_missing_columns()
+    if is_new:
+      self.import_existing_store()
+    else:
+      version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+      if version < RELATIVE_PATHS_VERSION:
+        self._make_paths_relative()
+      if version < TRADING_TYPES_VERSION:
+        self._add_trading_types()
+    self.connection.execute(f"PRAGMA user_version = {TRADING_TYPES_VERSION}")
+    self.connection.commit()
+
+  def _to_stored(self, path):
+    """path as stored: relative to the manifest folder when it is inside it, else absolute."""
+    if path is None:
+      return None
+    absolute = os.path.abspath(path)
+    try:
+      relative = os.path.relpath(absolute, self.root)
+    except ValueError:
+      # another drive
+      return absolute
+    if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+      return absolute
+    return Path(relative).as_posix()
+
+  def _resolve(self, stored):
+    """Absolute path of a stored path."""
+    if stored is None:
+      return None
+    return os.path.normpath(os.path.join(self.root, stored))
+
+  def _is_stored_form(self, path):
+    # relative to the manifest folder already, not to the working directory
+    return path is None or (not os.path.isabs(path) and not os.path.exists(path) and os.path.exists(self._resolve(path)))
+
+  def _make_paths_relative(self):
+    # older manifests stored paths as they were given, relative to the working directory of the run
+    for table, key, columns in (('archives', 'url', ('path', 'extracted_path')), ('merged_outputs', 'path', ('path',))):
+      for row in self.connection.execute(f"SELECT {key}, {', '.join(columns)} FROM {table}").fetchall():
+        stored = [path if self._is_stored_form(path) else self._to_stored(path) for path in row[1:]]
+        if stored != list(row[1:]):
+          self.connection.execute(f"UPDATE OR IGNORE {table} SET {', '.join(f'{column} = ?' for column in columns)} WHERE {key} = ?",
+                                  (*stored, row[0]))
+
+  def _add_trading_types(self):
+    # older manifests imported trades and aggTrades archives as klines, and kept no trading type
+    for url, in self.connection.execute("SELECT url FROM archives WHERE trading_type IS NULL").fetchall():
+      if not _is_klines_path(url):
+        self.connection.execute("DELETE FROM archives WHERE url = ?", (url,))
+      else:
+        self.connection.execute("UPDATE archives SET trading_type = ? WHERE url = ?", (parse_archive_path(url)[0], url))
+    self._fill_merged_trading_types()
+
+  def _fill_merged_trading_types(self):
+    # merged outputs take the trading type of the symbol's archives, spot when there are none
+    self.connection.execute(
+      "UPDATE merged_outputs SET trading_type = COALESCE((SELECT MIN(a.trading_type) FROM archives a WHERE a.symbol = merged_outputs.symbol), 'spot') "
+      "WHERE trading_type IS NULL")
+
+  def _add_missing_columns(self):
+    # manifests written before merged outputs could go stale, or were kept per interval
+    archive_columns = [row[1] for row in self.connection.execute("PRAGMA table_info(archives)")]
+    if 'merged' not in archive_columns:
+      self.connection.execute("ALTER TABLE archives ADD COLUMN merged INTEGER NOT NULL DEFAULT 0")
+    if 'trading_type' not in archive_columns:
+      self.connection.execute("ALTER TABLE archives ADD COLUMN trading_type TEXT")
+    columns = [row[1] for row in self.connection.execute("PRAGMA table_info(merged_outputs)")]
+    if 'stale' not in columns:
+      self.connection.execute("ALTER TABLE merged_outputs ADD COLUMN stale INTEGER NOT NULL DEFAULT 0")
+    if 'interval' not in columns:
+      self.connection.execute("ALTER TABLE merged_outputs ADD COLUMN interval TEXT")
+    if 'superseded' not in columns:
+      self.connection.execute("ALTER TABLE merged_outputs ADD COLUMN superseded INTEGER NOT NULL DEFAULT 0")
+    if 'trading_type' not in columns:
+      self.connection.execute("ALTER TABLE merged_outputs ADD COLUMN trading_type TEXT")
+
+  def close(self):
+    self.connection.commit()
+    self.connection.close()
+
+  def commit(self):
+    self.connection.commit()
+
+  def record_archive(self, url, path, extracted_path=None, size=None, etag=None, last_modified=None, checksum=None):
+    """Records a downloaded archive. Returns True when it replaced a different copy of the same url."""
+    parsed = parse_archive_name(path)
+    # trades and aggTrades archives are merged by merge_csv_by_symbol.py, not tracked here
+    if parsed is None or not _is_klines_path(url):
+      return False
+    trading_type = parse_archive_path(url)[0]
+    symbol, interval, period, start_date, end_date = parsed
+    previous = self.connection.execute("SELECT etag, checksum FROM archives WHERE url = ?", (url,)).fetchone()
+    changed = previous is not None and \
+      ((previous[0] and etag and previous[0] != etag) or (previous[1] and checksum and previous[1] != checksum))
+    self.connection.execute(
+      "INSERT INTO archives (url, trading_type, symbol, interval, period, start_date, end_date, path, extracted_path, size, etag, last_modified, checksum, downloaded_at) "
+      "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+      "ON CONFLICT(url) DO UPDATE SET path=excluded.path, extracted_path=excluded.extracted_path, size=excluded.size, "
+      "etag=excluded.etag, last_modified=excluded.last_modified, checksum=COALESCE(excluded.checksum, archives.checksum), "
+      "downloaded_at=excluded.downloaded_at, merged=0",
+      (url, trading_type, symbol, interval, period, start_date.isoformat(), end_date.isoformat(), self._to_stored(path),
+       self._to_stored(extracted_path), size, etag, last_modified, checksum, _now()))
+    self.connection.execute("DELETE FROM missing_archives WHERE url = ?", (url,))
+    if changed:
+      self.mark_merged_stale(symbol, start_date, end_date, interval, trading_type)
+    return bool(changed)
+
+  def record_checksum(self, url, checksum):
+    self.connection.execute("UPDATE archives SET checksum = ? WHERE url = ?", (checksum, url))
+
+  def record_missing(self, url):
+    """Remembers that url answered 404, for as long as get_missing_ttl allows for its period."""
+    parsed = parse_archive_name(url.rsplit('/', 1)[-1].replace('.CHECKSUM', ''))
+    end_date = parsed[4] if parsed else None
+    ttl = get_missing_ttl(end_date) if end_date else MISSING_RECENT_TTL
+    now = datetime.now(timezone.utc)
+    expires_at = (now + ttl).isoformat(timespec='seconds') if ttl is not None else None
+    self.connection.execute(
+      "INSERT OR REPLACE INTO missing_archives (url, end_date, checked_at, expires_at) VALUES (?, ?, ?, ?)",
+      (url, end_date.isoformat() if end_date else None, now.isoformat(timespec='seconds'), expires_at))
+
+  def known_missing_urls(self):
+    """Set of urls whose cached 404 has not expired yet."""
+    return {row[0] for row in self.connection.execute(
+      "SELECT url FROM missing_archives WHERE expires_at IS NULL OR expires_at > ?", (_now(),))}
+
+  def first_archive_months(self):
+    """{monthly prefix: 'YYYY-MM'} of the first monthly archives found so far."""
+    return dict(self.connection.execute("SELECT prefix, first_month FROM first_archives"))
+
+  def record_first_archive_months(self, first_months):
+    self.connection.executemany(
+      "INSERT OR REPLACE INTO first_archives (prefix, first_month, discovered_at) VALUES (?, ?, ?)",
+      [(prefix, month, _now()) for prefix, month in first_months.items()])
+    self.connection.commit()
+
+  def archive_validators(self, url):
+    """(etag, last_modified) of url when its extracted csv is still on disk, else (None, None)."""
+    row = self.connection.execute(
+      "SELECT etag, last_modified, extracted_path FROM archives WHERE url = ?", (url,)).fetchone()
+    if row is None or not row[2] or not os.path.exists(self._resolve(row[2])):
+      return None, None
+    return row[0], row[1]
+
+  def archives_to_revalidate(self, symbols=None, trading_type=None):
+    """(url, path, symbol, interval, etag, last_modified) of every archive that can be revalidated, oldest first."""
+    # filtered here rather than with IN (...), since a whole exchange has more symbols than sqlite takes parameters
+    symbols = {symbol.upper() for symbol in symbols} if symbols else None
+    type_filter, params = _trading_type_filter(trading_type)
+    return [(row[0], self._resolve(row[1]), *row[2:6]) for row in self.connection.execute(
+      "SELECT url, path, symbol, interval, etag, last_modified, extracted_path FROM archives "
+      f"WHERE (etag IS NOT NULL OR last_modified IS NOT NULL){type_filter} ORDER BY symbol, start_date, period", params)
+            if (symbols is None or row[2] in symbols) and row[6] and os.path.exists(self._resolve(row[6]))]
+
+  def archive_checksums(self):
+    """{absolute path: sha256} of every archive whose checksum is recorded."""
+    return {self._resolve(path): checksum for path, checksum in self.connection.execute(
+      "SELECT path, checksum FROM archives WHERE checksum IS NOT NULL")}
+
+  def forget_archive(self, path):
+    """Drops the archive saved at path, so the next run downloads it again, and marks the merged outputs it fed stale."""
+    path = self._to_stored(path)
+    row = self.connection.execute(
+      "SELECT symbol, start_date, end_date, interval, trading_type FROM archives WHERE path = ?", (path,)).fetchone()
+    if row is None:
+      return False
+    self.connection.execute("DELETE FROM archives WHERE path = ?", (path,))
+    self.mark_merged_stale(row[0], date.fromisoformat(row[1]), date.fromisoformat(row[2]), row[3], row[4])
+    self.connection.commit()
+    return True
+
+  def mark_merged_stale(self, symbol, start_date, end_date, interval=None, trading_type=None):
+    """Marks the merged outputs of symbol that overlap start_date..end_date stale. Returns how many were marked.
+
+    With an interval or a trading type, dataset partitions of other intervals or trading types are left alone.
+    """
+    query = "UPDATE merged_outputs SET stale = 1 WHERE symbol = ? AND start_date <= ? AND end_date >= ? AND stale = 0"
+    params = [symbol.upper(), end_date.isoformat(), start_date.isoformat()]
+    if interval:
+      query += " AND (interval IS NULL OR interval = ?)"
+      params.append(interval)
+    type_filter, type_params = _trading_type_filter(trading_type)
+    return self.connection.execute(query + type_filter, params + type_params).rowcount
+
+  def record_merged_output(self, path, symbol, start_time, end_time, rows, interval=None, trading_type='spot'):
+    """Records a merged output, or a dataset partition of interval, covering start_time..end_time (ms).
+
+    A dataset partition also supersedes the stale per-symbol outputs of an older store
+    (those without an interval) that the dataset now spans, so they stop holding back planning.
+    """
+    path = self._to_stored(path)
+    start_date = datetime.fromtimestamp(start_time / 1000, timezone.utc).date()
+    end_date = datetime.fromtimestamp(end_time / 1000, timezone.utc).date()
+    # a stale output that the new one covers has been rebuilt; drop it
+    superseded = self.connection.execute(
+      "SELECT path FROM merged_outputs WHERE symbol = ? AND interval IS ? AND trading_type = ? AND stale = 1 "
+      "AND start_date >= ? AND end_date <= ? AND path != ?",
+      (symbol.upper(), interval, trading_type, start_date.isoformat(), end_date.isoformat(), path)).fetchall()
+    for (superseded_path,) in superseded:
+      if os.path.exists(self._resolve(superseded_path)):
+        os.remove(self._resolve(superseded_path))
+      self.connection.execute("DELETE FROM merged_outputs WHERE path = ?", (superseded_path,))
+      print(f"Removed stale merged output: {self._resolve(superseded_path)}")
+    self.connection.execute(
+      "INSERT OR REPLACE INTO merged_outputs (path, trading_type, symbol, interval, start_date, end_date, start_time, end_time, rows, created_at) "
+      "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+      (path, trading_type, symbol.upper(), interval, start_date.isoformat(), end_date.isoformat(), start_time, end_time, rows, _now()))
+    if interval:
+      # their files are left alone, they may be all an older store has of other intervals
+      self.connection.execute(
+        "UPDATE merged_outputs SET superseded = 1 WHERE symbol = ? AND trading_type = ? AND interval IS NULL AND stale = 1 AND superseded = 0 "
+        "AND end_date <= ? AND start_date >= (SELECT MIN(start_date) FROM merged_outputs "
+        "WHERE symbol = ? AND trading_type = ? AND interval = ? AND stale = 0)",
+        (symbol.upper(), trading_type, end_date.isoformat(), symbol.upper(), trading_type, interval))
+    self.connection.commit()
+
+  def latest_merged_end_date(self, symbol, interval=None, trading_type=None):
+    """End date of the merged data for symbol, or the day before its earliest stale merged output.
+
+    With an interval only that interval's dataset and the older per-symbol outputs count.
+    Outputs a dataset has superseded never do.
+    """
+    where = "symbol = ? AND superseded = 0"
+    params = [symbol.upper()]
+    if interval:
+      where += " AND (interval IS NULL OR interval = ?)"
+      params.append(interval)
+    type_filter, type_params = _trading_type_filter(trading_type)
+    where += type_filter
+    params += type_params
+    row = self.connection.execute(
+      f"SELECT MIN(start_date) FROM merged_outputs WHERE {where} AND stale = 1", params).fetchone()
+    if row and row[0]:
+      return date.fromisoformat(row[0]) - timedelta(days=1)
+    row = self.connection.execute(
+      f"SELECT MAX(end_date) FROM merged_outputs WHERE {where}", params).fetchone()
+    return date.fromisoformat(row[0]) if row and row[0] else None
+
+  def archive_intervals(self, symbol, trading_type=None):
+    """Intervals symbol has extracted archives for."""
+    type_filter, params = _trading_type_filter(trading_type)
+    return [row[0] for row in self.connection.execute(
+      "SELECT DISTINCT interval FROM archives WHERE symbol = ? AND interval IS NOT NULL AND extracted_path IS NOT NULL"
+      f"{type_filter} ORDER BY interval", [symbol.upper()] + params)]
+
+  def dataset_partitions(self, symbol, interval, trading_type='spot'):
+    """{'YYYY-MM': {'path', 'start_time', 'end_time', 'rows', 'stale'}} of the dataset partitions of symbol and interval."""
+    return {row[1][:7]: {'path': self._resolve(row[0]), 'start_time': row[2], 'end_time': row[3], 'rows': row[4], 'stale': bool(row[5])}
+            for row in self.connection.execute(
+              "SELECT path, start_date, start_time, end_time, rows, stale FROM merged_outputs "
+              "WHERE symbol = ? AND interval = ? AND trading_type = ?",
+              (symbol.upper(), interval, trading_type))}
+
+  def dataset_inputs(self, symbol, interval, trading_type='spot'):
+    """Extracted paths the dataset of symbol and interval has not taken in yet, oldest first.
+
+    That is every archive downloaded since it was last merged, and every archive
+    overlapping one of the dataset's stale partitions, which has to be rebuilt.
+    """
+    paths = [self._resolve(row[0]) for row in self.connection.execute(
+      "SELECT extracted_path FROM archives WHERE symbol = ? AND interval = ? AND trading_type = ? AND extracted_path IS NOT NULL "
+      "AND (merged = 0 OR EXISTS (SELECT 1 FROM merged_outputs m WHERE m.symbol = archives.symbol AND m.interval = archives.interval "
+      "AND m.trading_type = archives.trading_type AND m.stale = 1 AND m.start_date <= archives.end_date AND m.end_date >= archives.start_date)) "
+      "ORDER BY start_date, period", (symbol.upper(), interval, trading_type))]
+    return [path for path in paths if os.path.exists(path)]
+
+  def record_dataset_inputs_merged(self, extracted_paths):
+    self.connection.executemany("UPDATE archives SET merged = 1 WHERE extracted_path = ?", [(self._to_stored(path),) for path in extracted_paths])
+    self.connection.commit()
+
+  def import_existing_store(self):
+    """Records the extracted kline csvs and merged outputs already in folder, once, so older stores keep working."""
+    imported = 0
+    data_root = Path(self.folder) / 'data'
+    if data_root.is_dir():
+      for csv_path in data_root.rglob('*.csv'):
+        if not _is_klines_path(csv_path):
+          continue
+        relative = csv_path.relative_to(self.folder).with_suffix('.zip').as_posix()
+        self.record_archive(get_download_url(relative), str(csv_path.with_suffix('.zip')), extracted_path=str(csv_path))
+        imported += 1
+      # archives kept zipped (-keep-csv 0) are read straight from the zip
+      for zip_path in data_root.rglob('*.zip'):
+        if _is_klines_path(zip_path) and not zip_path.with_suffix('.csv').exists():
+          relative = zip_path.relative_to(self.folder).as_posix()
+          self.record_archive(get_download_url(relative), str(zip_path), extracted_path=str(zip_path))
+          imported += 1
+    for merged_path in Path(self.folder).glob('*_*_*.csv'):
+      match = MERGED_NAME_PATTERN.match(merged_path.name)
+      if not match:
+        continue
+      start_date = datetime.strptime(match.group('start'), "%Y%m%d").date()
+      end_date = datetime.strptime(match.group('end'), "%Y%m%d").date()
+      self.connection.execute(
+        "INSERT OR IGNORE INTO merged_outputs (path, symbol, start_date, end_date, created_at) VALUES (?, ?, ?, ?, ?)",
+        (self._to_stored(merged_path), match.group('symbol'), start_date.isoformat(), end_date.isoformat(), _now()))
+      imported += 1
+    self._fill_merged_trading_types()
+    self.connection.commit()
+    if imported:
+      print(f"Imported {imported} existing files into {self.path}")
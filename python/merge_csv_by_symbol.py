@@ -3,7 +3,8 @@
 """
 Merges multiple CSV files belonging to the same trading symbol into a single
 CSV file per symbol. It intelligently determines column headers from the
-most recent file for each symbol.
+most recent file for each symbol, and streams the files through a k-way
+merge so a symbol's history never has to fit in memory.
 """
 
 import os
@@ -11,11 +12,22 @@ import sys
 import argparse
 from pathlib import Path
 import pandas as pd
-from datetime import date, timedelta, datetime # datetime might be needed by pandas or for strptime if used
+from datetime import date, timedelta, datetime, timezone # datetime might be needed by pandas or for strptime if used
 import re
 import numpy as np
 import glob # For Path.glob or direct glob usage
 from collections import defaultdict
+from functools import partial
+from itertools import chain
+
+from enums import MERGE_MEMORY_BUDGET_MB
+from merger import merge_sorted_chunks, rechunk, external_sort, UnsortedSourceError
+from readers import SCHEMAS, TIME_COLUMNS, EPOCH_COLUMNS, ENGINES, TIME_UNITS, TIME_UNIT_FACTORS, open_csv, get_columns, \
+    iter_archive, get_time_unit, convert_time_unit
+
+# Millisecond timestamps pandas can turn into datetimes
+TIMESTAMP_MIN_MS = -(-pd.Timestamp.min.value // 10**6)
+TIMESTAMP_MAX_MS = pd.Timestamp.max.value // 10**6
 
 # --- Functions copied from download-kline.py ---
 
@@ -76,7 +88,96 @@ def parse_date_from_filename(filename):
     return date(1970, 1, 1)
 
 
-def merge_symbol_klines_csvs(symbol, csv_file_paths, output_directory):
+def parse_start_ms_from_filename(filename):
+    """
+    First millisecond a kline CSV can hold, from the date in its name: 00:00 UTC of the day
+    for SYMBOL-INTERVAL-YYYY-MM-DD.csv, of the first day of the month for SYMBOL-INTERVAL-YYYY-MM.csv.
+    Returns None when the name has no date, so the file is read from the start of the merge.
+    """
+    match = re.search(r'(\d{4})-(\d{2})(?:-(\d{2}))?(?!\d)', Path(filename).stem)
+    if not match:
+        return None
+    try:
+        start = date(int(match.group(1)), int(match.group(2)), int(match.group(3) or 1))
+    except ValueError:
+        return None
+    return int(datetime(start.year, start.month, start.day, tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def read_aligned_chunks(f_path, canonical_header, data_type='klines', engine='c', unit='ms', failed_paths=None):
+    """
+    Reads one CSV (or zip) in typed chunks of about MERGE_CHUNK_ROWS rows, with the schema of
+    data_type, aligned to canonical_header. Times are rescaled to unit from the unit of the file,
+    judged from the magnitude of its first chunk. Rows whose time pandas cannot represent
+    are dropped. Errors are reported and end the file, which is added to failed_paths, if given.
+    """
+    time_col_name = TIME_COLUMNS[data_type]
+    factor = TIME_UNIT_FACTORS[unit]
+    file_unit = None
+    try:
+        for df in iter_archive(f_path, data_type, engine=engine):
+            if file_unit is None:
+                file_unit = get_time_unit(df[time_col_name])
+                if file_unit != unit:
+                    print(f"Converting {file_unit} timestamps in {f_path} to {unit}")
+            df = convert_time_unit(df, [col for col in EPOCH_COLUMNS[data_type] if col in df.columns], file_unit, unit)
+            if df.columns.tolist() != canonical_header:
+                # Align columns to canonical_header; columns this file lacks are left empty
+                df = df.reindex(columns=canonical_header)
+            valid = df[time_col_name].between(TIMESTAMP_MIN_MS * factor, TIMESTAMP_MAX_MS * factor)
+            yield df if valid.all() else df[valid]
+
+    except pd.errors.EmptyDataError:
+        print(f"Warning: Empty CSV file encountered: {f_path}, skipping.")
+    except Exception as e:
+        print(f"Error processing CSV {f_path}: {e}, skipping the rest of it.")
+        if failed_paths is not None:
+            failed_paths.add(str(f_path))
+
+
+def read_first_key(f_path, key_col_name, data_type='klines'):
+    """
+    First value of key_col_name in a CSV (or zip), which bounds the keys of a sorted file from below.
+    Returns None when it cannot be read, so the file is read from the start of the merge.
+    """
+    try:
+        for df in iter_archive(f_path, data_type, chunksize=1):
+            return int(df[key_col_name].iloc[0])
+    except Exception:
+        return None
+    return None
+
+
+def write_merged_chunks(merged_chunks, output_file_path, time_col_name):
+    """
+    Writes merged chunks to output_file_path as they come, with the header once.
+    Returns (rows, earliest time, latest time).
+    """
+    rows = 0
+    min_timestamp = max_timestamp = None
+    for chunk in rechunk(merged_chunks):
+        # Save with the header once, which will use the DataFrame's column names (the canonical_header)
+        chunk.to_csv(output_file_path, index=False, header=rows == 0, mode='w' if rows == 0 else 'a')
+        chunk_min, chunk_max = int(chunk[time_col_name].min()), int(chunk[time_col_name].max())
+        min_timestamp = chunk_min if min_timestamp is None else min(min_timestamp, chunk_min)
+        max_timestamp = chunk_max if max_timestamp is None else max(max_timestamp, chunk_max)
+        rows += len(chunk)
+    return rows, min_timestamp, max_timestamp
+
+
+def merge_symbol_klines_csvs(symbol, csv_file_paths, output_directory, memory_budget=None, data_type='klines', engine='c', unit='ms'):
+    """
+    Merges the CSVs of one symbol into SYMBOL_<first date>_<last date>.csv in output_directory.
+    Files are read with the typed schema of data_type (see readers.SCHEMAS) by engine, 'c' or 'pyarrow'.
+    Times are written in unit: 'ms', or 'us' to keep the microseconds of archives since 2025.
+    Every file is expected to be sorted by its first column, as binance archives are; the files
+    are streamed through a k-way merge, so memory grows with the number of files that overlap
+    in time rather than with the size of the symbol's history.
+    With memory_budget (MB), or when a file turns out not to be sorted, the rows are sorted
+    out of core instead: in runs of that size spilled to output_directory, then merged.
+    A file that fails to read partway fails the merge: the output is left as SYMBOL.csv.part
+    and never given a final name, which would pass it off as the symbol's full history.
+    """
     if not csv_file_paths:
         print(f"No CSV files provided for symbol {symbol}. Skipping merge.")
         return
@@ -100,10 +201,11 @@ def merge_symbol_klines_csvs(symbol, csv_file_paths, output_directory):
                 latest_file_for_header = None # Reset to try next
                 continue
             
-            # Read only the header row
-            header_df = pd.read_csv(latest_file_for_header, nrows=0, low_memory=False)
-            if not header_df.columns.empty:
-                canonical_header = header_df.columns.tolist()
+            # Read only the header row, or name the columns of a file without one from the schema
+            with open_csv(latest_file_for_header) as f_peek:
+                header_columns, _ = get_columns(f_peek, data_type)
+            if header_columns:
+                canonical_header = header_columns
                 print(f"Using header from {latest_file_for_header.name} as canonical for {symbol}: {canonical_header}")
                 break
             else:
@@ -121,140 +223,74 @@ def merge_symbol_klines_csvs(symbol, csv_file_paths, output_directory):
         print(f"Critical: Could not determine a canonical header for symbol {symbol} after checking all files. Skipping merge for this symbol.")
         return
 
-    # B. Processing Individual CSVs & Data Collection
-    data_to_merge = []  # List of (file_date, dataframe) tuples
-
-    for f_path_str in csv_file_paths: # Process all files, not necessarily sorted here
+    # B. Streaming each CSV, aligned to the canonical header
+    timestamp_col_name = canonical_header[0] # Use the first column from canonical_header (open_time, or the trade id)
+    time_col_name = TIME_COLUMNS[data_type]
+    sources = []
+    failed_paths = set()
+    # Earlier files by name date win over later ones when both hold a timestamp
+    for f_path_str in sorted(csv_file_paths, key=lambda p: parse_date_from_filename(Path(p).name)):
         f_path = Path(f_path_str)
         if not f_path.exists():
             print(f"Warning: File not found {f_path_str}, skipping.")
             continue
-        
-        file_date = parse_date_from_filename(f_path.name)
-
-        try:
-            has_header = False
-            if f_path.stat().st_size > 0: # Check if file is not empty
-                with open(f_path, 'r', encoding='utf-8') as f_peek:
-                    first_line = f_peek.readline().strip()
-                    if first_line: # Ensure first line is not empty
-                        first_field = first_line.split(',')[0]
-                        try:
-                            # Attempt to convert the first field to a number
-                            float(first_field)
-                            # If successful, it's likely data, not a header
-                            has_header = False
-                        except ValueError:
-                            # If ValueError, it's likely a header string
-                            has_header = True
-            else: # File is empty
-                print(f"Skipping empty file: {f_path_str}")
-                continue
-
-            df = None
-            if has_header:
-                df = pd.read_csv(f_path, low_memory=False, dtype=str) # Read all as str initially
-                if df.empty:
-                    print(f"Skipping empty dataframe from (header-detected) file: {f_path_str}")
-                    continue
-                
-                # Align columns to canonical_header
-                # Create a new DataFrame with canonical_header and fill from df
-                aligned_df = pd.DataFrame(columns=canonical_header, dtype=str)
-                for col in canonical_header:
-                    if col in df.columns:
-                        aligned_df[col] = df[col]
-                    else:
-                        aligned_df[col] = pd.NA # Use pandas NA for missing
-                df = aligned_df
-            else: # No header detected or file was empty initially
-                df = pd.read_csv(f_path, header=None, names=canonical_header, low_memory=False, dtype=str)
-                if df.empty:
-                    print(f"Skipping empty dataframe from (no-header-detected) file: {f_path_str}")
-                    continue
-            
-            data_to_merge.append((file_date, df))
-
-        except pd.errors.EmptyDataError:
-            print(f"Warning: Empty CSV file encountered: {f_path_str}, skipping.")
-            continue
-        except Exception as e:
-            print(f"Error processing CSV {f_path_str}: {e}, skipping.")
+        if f_path.stat().st_size == 0:
+            print(f"Skipping empty file: {f_path_str}")
             continue
-
-    # C. Sorting, Concatenation, Final Processing
-    if not data_to_merge:
+        # A file name dates times; a trade id bound has to be read from the file itself
+        if timestamp_col_name == time_col_name:
+            lower_bound = parse_start_ms_from_filename(f_path.name)
+            lower_bound = lower_bound * TIME_UNIT_FACTORS[unit] if lower_bound is not None else None
+        else:
+            lower_bound = read_first_key(f_path, timestamp_col_name, data_type)
+        sources.append((lower_bound, partial(read_aligned_chunks, f_path, canonical_header, data_type, engine, unit, failed_paths)))
+
+    if not sources:
         print(f"No data collected to merge for symbol {symbol}. Skipping.")
         return
 
-    # Sort data by file_date (ascending) before concatenation
-    data_to_merge.sort(key=lambda x: x[0])
+    # C. k-way merge of the sorted files (or of sorted runs spilled to disk), written out as it goes
+    partial_file_path = Path(output_directory) / f"{symbol.upper()}.csv.part"
 
-    # Concatenate all dataframes
-    merged_df = pd.concat([item[1] for item in data_to_merge], ignore_index=True)
+    def external_sort_sources(budget_mb):
+        chunks = chain.from_iterable(open_chunks() for _, open_chunks in sources)
+        return external_sort(chunks, timestamp_col_name, budget_mb * 1024 * 1024, output_directory)
 
-    if merged_df.empty:
-        print(f"Merged dataframe for {symbol} is empty. Skipping save.")
+    try:
+        if memory_budget:
+            rows, min_timestamp, max_timestamp = write_merged_chunks(external_sort_sources(memory_budget), partial_file_path, time_col_name)
+        else:
+            try:
+                rows, min_timestamp, max_timestamp = write_merged_chunks(merge_sorted_chunks(sources, timestamp_col_name), partial_file_path, time_col_name)
+            except UnsortedSourceError as e:
+                # Overlapping or re-issued files can break the order the streaming merge relies on
+                print(f"Warning: {e} for {symbol}. Merging again with an external sort ({MERGE_MEMORY_BUDGET_MB} MB runs).")
+                failed_paths.clear()
+                rows, min_timestamp, max_timestamp = write_merged_chunks(external_sort_sources(MERGE_MEMORY_BUDGET_MB), partial_file_path, time_col_name)
+    except Exception as e:
+        print(f"Error merging CSVs for {symbol} into {partial_file_path}: {e}")
+        partial_file_path.unlink(missing_ok=True)
         return
 
-    if not merged_df.columns.tolist() == canonical_header: # Should match due to earlier alignment
-        print(f"Warning: Merged DF columns {merged_df.columns.tolist()} do not match canonical {canonical_header} for {symbol}. This is unexpected.")
-        # Attempt to re-align, though this indicates a logic flaw if it happens.
-        final_df_for_save = pd.DataFrame(columns=canonical_header)
-        for col in canonical_header:
-            if col in merged_df.columns:
-                final_df_for_save[col] = merged_df[col]
-            else:
-                final_df_for_save[col] = pd.NA
-        merged_df = final_df_for_save
-
-
-    timestamp_col_name = canonical_header[0] # Use the first column from canonical_header
-
-    # Convert timestamp column to numeric, then to datetime
-    # Coerce errors: invalid parsing will be set as NaT
-    merged_df[timestamp_col_name] = pd.to_numeric(merged_df[timestamp_col_name], errors='coerce')
-    merged_df.dropna(subset=[timestamp_col_name], inplace=True) # Drop rows where conversion to numeric failed
-
-    if merged_df.empty:
-        print(f"Dataframe for {symbol} is empty after numeric conversion of timestamp. Skipping.")
+    if failed_paths:
+        print(f"Error: {len(failed_paths)} files for {symbol} could not be read in full ({', '.join(sorted(failed_paths))}). "
+              f"Left the partial merge in {partial_file_path}; fix or re-download them and merge again.")
         return
 
-    # Convert to datetime, assuming milliseconds Unix timestamp
-    merged_df[timestamp_col_name] = pd.to_datetime(merged_df[timestamp_col_name], unit='ms', errors='coerce')
-    merged_df.dropna(subset=[timestamp_col_name], inplace=True) # Drop rows where timestamp conversion failed (NaT)
-
-    if merged_df.empty:
-        print(f"Dataframe for {symbol} is empty after datetime conversion/dropna. Skipping save.")
+    if not rows:
+        print(f"Dataframe for {symbol} is empty after timestamp conversion and deduplication. Skipping save.")
         return
 
-    # Sort by the timestamp column (ascending)
-    merged_df.sort_values(by=timestamp_col_name, inplace=True)
-
-    # Deduplicate based on the timestamp column, keeping the first occurrence
-    merged_df.drop_duplicates(subset=[timestamp_col_name], keep='first', inplace=True)
-
-    if merged_df.empty: # Check again after deduplication
-        print(f"Dataframe for {symbol} is empty after deduplication. Skipping save.")
-        return
-
-    # Derive min_date_str and max_date_str from the processed timestamp column
-    min_date_dt = merged_df[timestamp_col_name].min()
-    max_date_dt = merged_df[timestamp_col_name].max()
-    min_date_str = min_date_dt.strftime('%Y%m%d')
-    max_date_str = max_date_dt.strftime('%Y%m%d')
-
-    # Convert timestamp column back to int64 (milliseconds epoch)
-    # Timestamps are already datetime objects, convert to Unix time in ms
-    merged_df[timestamp_col_name] = (merged_df[timestamp_col_name].astype(np.int64) // 10**6)
+    # Derive min_date_str and max_date_str from the earliest and latest merged times
+    min_date_str = pd.to_datetime(min_timestamp, unit=unit).strftime('%Y%m%d')
+    max_date_str = pd.to_datetime(max_timestamp, unit=unit).strftime('%Y%m%d')
 
     output_filename = f"{symbol.upper()}_{min_date_str}_{max_date_str}.csv"
     output_file_path = Path(output_directory) / output_filename
 
     try:
-        # Save with header=True, which will use the DataFrame's column names (the canonical_header)
-        merged_df.to_csv(output_file_path, index=False, header=True)
-        print(f"Successfully merged {len(csv_file_paths)} initial files (processed {len(data_to_merge)} non-empty dataframes) for {symbol} into: {output_file_path}")
+        os.replace(partial_file_path, output_file_path)
+        print(f"Successfully merged {len(csv_file_paths)} initial files (streamed {len(sources)} non-empty files, {rows} rows) for {symbol} into: {output_file_path}")
     except Exception as e:
         print(f"Error saving merged CSV for {symbol} to {output_file_path}: {e}")
 
@@ -289,7 +325,41 @@ def main():
         default="*.csv",
         help="Glob pattern to use for finding CSV files within each symbol's subdirectory (e.g., \"*.csv\", \"DATA-*.csv\"). Default is \"*.csv\"."
     )
+    parser.add_argument(
+        "--data_type",
+        type=str,
+        default="klines",
+        choices=list(SCHEMAS),
+        help="Binance data type of the files, which fixes the column types they are read with. Default is \"klines\"."
+    )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        default="c",
+        choices=ENGINES,
+        help="CSV parser: \"c\" (pandas) or \"pyarrow\" (multithreaded, needs pyarrow installed). Default is \"c\"."
+    )
+    parser.add_argument(
+        "--timestamp_unit",
+        type=str,
+        default="ms",
+        choices=TIME_UNITS,
+        help="Resolution of the times written: \"ms\", or \"us\" to keep the microseconds of archives since 2025. "
+             "Files in either unit are converted. Default is \"ms\"."
+    )
+    parser.add_argument(
+        "--memory_budget",
+        type=int,
+        default=None,
+        help="Sort out of core: read files in sorted runs of about this many MB, spilled to the output directory, then merge the runs. "
+             f"Use it when files overlap or are not sorted. By default files are merged as they are sorted, falling back to {MERGE_MEMORY_BUDGET_MB} MB runs if one is not."
+    )
     args = parser.parse_args()
+    if args.engine == 'pyarrow':
+        try:
+            import pyarrow
+        except ImportError:
+            parser.error("--engine pyarrow needs pyarrow installed, e.g. pip install pyarrow")
 
     input_path = Path(args.input_dir)
     output_path = Path(args.output_dir)
@@ -346,7 +416,7 @@ def main():
     for symbol, file_list in files_by_symbol.items():
         print(f"\nFound {len(file_list)} files for symbol {symbol.upper()}.")
         print(f"Merging files for symbol {symbol.upper()}...")
-        merge_symbol_klines_csvs(symbol.upper(), file_list, str(output_path))
+        merge_symbol_klines_csvs(symbol.upper(), file_list, str(output_path), args.memory_budget, args.data_type, args.engine, args.timestamp_unit)
 
     print("\nScript finished.")
 
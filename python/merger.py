@@ -0,0 +1,172 @@
+"""
+  streaming k-way merge of csv files that are each already sorted.
+
+  every binance archive is sorted by its first column, so merging a symbol's
+  history does not need all of it in memory and one big sort. each file is
+  read as a stream of DataFrame chunks, and a heap keyed on the first
+  unmerged timestamp of every open file picks which file to take rows from
+  next. while the files do not overlap in time, as with consecutive monthly
+  and daily archives, whole runs of rows are taken at once with a binary
+  search instead of one row at a time. rows repeating the previous
+  timestamp are dropped, so the first file in input order wins.
+
+  files are only opened once the merge reaches the lower bound of their
+  timestamps, usually the date in their name, so only the files that overlap
+  the current position are open at any time and memory stays at a few
+  chunks per open file.
+
+  when the files cannot be trusted to be sorted, e.g. overlapping or
+  re-issued archives, external_sort reads them in runs that fit a memory
+  budget, sorts each run and spills it to disk, then merges the runs the
+  same way.
+
+"""
+import heapq
+import os
+import pickle
+import tempfile
+from collections import deque
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from enums import MERGE_CHUNK_ROWS, SPILL_CHUNK_ROWS
+
+
+class UnsortedSourceError(ValueError):
+  """A source handed to merge_sorted_chunks is not sorted by the merge key."""
+
+
+def merge_sorted_chunks(sources, key):
+  """Yields the rows of every source as DataFrames in key order, without repeated keys.
+
+  sources is a list of (lower_bound, open_chunks) in input order, where
+  open_chunks() returns an iterator of DataFrames sorted by the int64 column
+  key, and lower_bound is at or below every key it yields, or None when
+  unknown, in which case the source is opened straight away. Ties between
+  sources go to the earlier one. Raises UnsortedSourceError on a source that is out of order.
+  """
+  pending = deque(sorted(enumerate(sources), key=lambda item: (item[1][0] is not None, item[1][0] or 0, item[0])))
+  states = {}
+  heap = []
+
+  def advance(index):
+    chunks, _, keys, _ = states[index]
+    floor = int(keys[-1]) if keys is not None else sources[index][0]
+    for chunk in chunks:
+      if len(chunk):
+        keys = chunk[key].to_numpy(dtype=np.int64)
+        # a source out of order would silently break the merge, so refuse it
+        if (floor is not None and keys[0] < floor) or (np.diff(keys) < 0).any():
+          raise UnsortedSourceError(f"source {index} is not sorted by {key} or starts before its lower bound")
+        states[index] = [chunks, chunk, keys, 0]
+        heapq.heappush(heap, (int(keys[0]), index))
+        return
+    del states[index]
+
+  def open_source(index, open_chunks):
+    states[index] = [iter(open_chunks()), None, None, 0]
+    advance(index)
+
+  last_key = None
+  while heap or pending:
+    # open every source whose first key could come before what the heap holds
+    while pending and (not heap or pending[0][1][0] is None or pending[0][1][0] <= heap[0][0]):
+      index, (_, open_chunks) = pending.popleft()
+      open_source(index, open_chunks)
+    if not heap:
+      continue
+
+    _, index = heapq.heappop(heap)
+    chunks, chunk, keys, position = states[index]
+    # take every row that no other source can precede
+    end = len(keys)
+    if heap:
+      next_key, next_index = heap[0]
+      end = min(end, int(np.searchsorted(keys, next_key, side='right' if index < next_index else 'left')))
+    if pending:
+      end = min(end, int(np.searchsorted(keys, pending[0][1][0], side='right' if index < pending[0][0] else 'left')))
+    end = max(end, position + 1)
+
+    taken = keys[position:end]
+    keep = np.empty(len(taken), dtype=bool)
+    keep[0] = last_key is None or taken[0] != last_key
+    keep[1:] = taken[1:] != taken[:-1]
+    last_key = int(taken[-1])
+    rows = chunk.iloc[position:end]
+    yield rows if keep.all() else rows[keep]
+
+    if end < len(keys):
+      states[index][3] = end
+      heapq.heappush(heap, (int(keys[end]), index))
+    else:
+      advance(index)
+
+def rechunk(frames, rows=MERGE_CHUNK_ROWS):
+  """Regroups a stream of DataFrames, however small, into DataFrames of about rows rows."""
+  buffered = []
+  buffered_rows = 0
+  for frame in frames:
+    if not len(frame):
+      continue
+    buffered.append(frame)
+    buffered_rows += len(frame)
+    if buffered_rows >= rows:
+      yield pd.concat(buffered, ignore_index=True)
+      buffered = []
+      buffered_rows = 0
+  if buffered:
+    yield pd.concat(buffered, ignore_index=True)
+
+def spill_sorted_runs(chunks, key, memory_budget, spill_dir):
+  """Sorts a stream of DataFrames in runs of about memory_budget bytes, each spilled to a file in spill_dir.
+
+  A run is sorted stably, so rows with the same key keep their input order. Returns the run paths in order.
+  """
+  runs = []
+  buffered = []
+  buffered_bytes = 0
+
+  def spill():
+    run = pd.concat(buffered, ignore_index=True).sort_values(key, kind='stable')
+    path = os.path.join(spill_dir, f"run-{len(runs):05d}.pkl")
+    with open(path, 'wb') as f:
+      # pickled in small pieces, so merging many runs holds one piece of each
+      for start in range(0, len(run), SPILL_CHUNK_ROWS):
+        pickle.dump(run.iloc[start:start + SPILL_CHUNK_ROWS], f, protocol=pickle.HIGHEST_PROTOCOL)
+    runs.append(path)
+    print(f"Spilled a sorted run of {len(run)} rows to {path}")
+
+  for chunk in chunks:
+    if not len(chunk):
+      continue
+    buffered.append(chunk)
+    buffered_bytes += int(chunk.memory_usage(deep=True).sum())
+    if buffered_bytes >= memory_budget:
+      spill()
+      buffered = []
+      buffered_bytes = 0
+  if buffered:
+    spill()
+  return runs
+
+def read_run(path):
+  with open(path, 'rb') as f:
+    while True:
+      try:
+        yield pickle.load(f)
+      except EOFError:
+        return
+
+def external_sort(chunks, key, memory_budget, spill_dir=None):
+  """Yields the rows of a stream of DataFrames in any order as DataFrames in key order, without repeated keys.
+
+  Holds about memory_budget bytes while reading (twice that while sorting a run) and
+  SPILL_CHUNK_ROWS rows per run while merging. Runs are written to a temporary folder
+  in spill_dir, removed once the merge is done. As with merge_sorted_chunks, the
+  earliest row of a key in input order wins.
+  """
+  with tempfile.TemporaryDirectory(prefix='merge-', dir=spill_dir) as run_dir:
+    runs = spill_sorted_runs(chunks, key, memory_budget, run_dir)
+    yield from merge_sorted_chunks([(None, partial(read_run, path)) for path in runs], key)
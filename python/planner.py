@@ -0,0 +1,182 @@
+"""
+  request planning helpers for the kline downloaders.
+
+  data.binance.vision is backed by an S3 bucket that answers prefix listings,
+  so instead of firing a GET at every year x month x interval (or every day)
+  for every symbol and collecting 404s, the planners can list each
+  data/<type>/<period>/klines/<SYMBOL>/<interval>/ prefix once and only
+  schedule keys that exist. iter_listings lists a few symbols ahead of the
+  planner and lets each symbol's listings go once it is planned, so memory
+  does not grow with the number of symbols.
+
+  the listing endpoint defaults to LISTING_URL and can be pointed at a local
+  stand-in server with the LISTING_URL environment variable.
+
+  without a listing, discover_first_months finds the first monthly archive of
+  each prefix with a binary search of HEAD requests, about 7 probes for the
+  ~100 months since START_DATE instead of one GET per month.
+
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+
+import requests
+
+from enums import MAX_IN_FLIGHT, LISTING_PREFETCH, REQUEST_TIMEOUT
+from utility import get_session, get_listing_url, get_download_url
+
+
+def _local_name(tag):
+  # S3 answers in the http://s3.amazonaws.com/doc/2006-03-01/ namespace
+  return tag.rsplit('}', 1)[-1]
+
+def _child_text(element, name):
+  for child in element:
+    if _local_name(child.tag) == name:
+      return child.text
+  return None
+
+def list_prefix(prefix, session=None):
+  """Returns {key: (size, etag)} for every object directly under prefix.
+
+  Follows IsTruncated / NextMarker pagination until the whole prefix is listed.
+  """
+  session = session or get_session()
+  objects = {}
+  marker = None
+  while True:
+    params = {'delimiter': '/', 'prefix': prefix}
+    if marker:
+      params['marker'] = marker
+    response = session.get(get_listing_url(), params=params, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    root = ElementTree.fromstring(response.content)
+
+    last_key = None
+    for element in root:
+      if _local_name(element.tag) != 'Contents':
+        continue
+      last_key = _child_text(element, 'Key')
+      objects[last_key] = (int(_child_text(element, 'Size') or 0), (_child_text(element, 'ETag') or '').strip('"'))
+
+    if (_child_text(root, 'IsTruncated') or '').lower() != 'true':
+      return objects
+    marker = _child_text(root, 'NextMarker') or last_key
+    if not marker:
+      return objects
+
+def list_prefixes(prefixes, max_workers=MAX_IN_FLIGHT):
+  """Lists every prefix in parallel, returning {prefix: objects}.
+
+  A prefix whose listing failed maps to None, so callers can fall back to
+  planning it blind instead of silently dropping it.
+  """
+  prefixes = list(dict.fromkeys(prefixes))
+  if not prefixes:
+    return {}
+  session = get_session()
+  with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(prefixes)))) as pool:
+    return dict(zip(prefixes, pool.map(lambda prefix: _safe_list(prefix, session), prefixes)))
+
+def iter_listings(prefix_groups, max_workers=MAX_IN_FLIGHT, prefetch=LISTING_PREFETCH):
+  """Yields {prefix: objects} for each group of prefixes, e.g. one symbol's intervals, in order.
+
+  Groups are listed in parallel at most prefetch groups ahead of the caller, and
+  nothing is kept once a group is yielded. Failed prefixes map to None, as in list_prefixes.
+  """
+  session = get_session()
+  groups = iter(prefix_groups)
+  pending = deque()
+  pool = ThreadPoolExecutor(max_workers=max(1, max_workers))
+  try:
+    while True:
+      while len(pending) < max(1, prefetch):
+        group = next(groups, None)
+        if group is None:
+          break
+        group = list(dict.fromkeys(group))
+        pending.append((group, [pool.submit(_safe_list, prefix, session) for prefix in group]))
+      if not pending:
+        return
+      group, futures = pending.popleft()
+      yield {prefix: future.result() for prefix, future in zip(group, futures)}
+  finally:
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _safe_list(prefix, session):
+  try:
+    return list_prefix(prefix, session)
+  except (requests.RequestException, ElementTree.ParseError) as e:
+    print(f"Warning: could not list {prefix}: {e}. Planning it without the listing.")
+    return None
+
+def is_listed(listings, path_segment, file_name):
+  """False only when path_segment was listed and file_name is not in it."""
+  listing = listings.get(path_segment)
+  return listing is None or f"{path_segment}{file_name}" in listing
+
+def archive_exists(session, url):
+  """HEAD probe; anything but a 200 or a 404 raises."""
+  response = session.head(url, timeout=REQUEST_TIMEOUT, allow_redirects=True)
+  if response.status_code == 404:
+    return False
+  response.raise_for_status()
+  return True
+
+def find_first_month(prefix, months, session=None):
+  """Binary-searches months (sorted YYYY-MM strings) for the first one with an archive under prefix.
+
+  Assumes archives run without gaps from the first month to the last. Returns
+  (month or None, probes). None means the last month, or the one before it
+  for a month not yet published, has no archive either, e.g. a delisted symbol.
+  """
+  session = session or get_session()
+  symbol, interval = prefix.rstrip('/').split('/')[-2:]
+  probes = 0
+
+  def exists(index):
+    nonlocal probes
+    probes += 1
+    return archive_exists(session, get_download_url("{}{}-{}-{}.zip".format(prefix, symbol, interval, months[index])))
+
+  hi = len(months) - 1
+  if hi < 0:
+    return None, probes
+  if not exists(hi):
+    hi -= 1
+    if hi < 0 or not exists(hi):
+      return None, probes
+  lo = 0
+  while lo < hi:
+    mid = (lo + hi) // 2
+    if exists(mid):
+      hi = mid
+    else:
+      lo = mid + 1
+  return months[lo], probes
+
+def discover_first_months(prefixes, months, max_workers=MAX_IN_FLIGHT):
+  """Runs find_first_month for every monthly prefix in parallel, returning {prefix: month}.
+
+  Prefixes that could not be resolved are left out, so callers plan them from
+  the requested start date as before.
+  """
+  prefixes = list(dict.fromkeys(prefixes))
+  if not prefixes:
+    return {}
+  session = get_session()
+
+  def safe_find(prefix):
+    try:
+      return find_first_month(prefix, months, session)
+    except requests.RequestException as e:
+      print(f"Warning: could not discover the first archive under {prefix}: {e}")
+      return None, 0
+
+  with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(prefixes)))) as pool:
+    results = dict(zip(prefixes, pool.map(safe_find, prefixes)))
+  probes = sum(probe_count for _, probe_count in results.values())
+  found = {prefix: month for prefix, (month, _) in results.items() if month}
+  print(f"Discovered the first monthly archive of {len(found)} of {len(prefixes)} prefixes with {probes} HEAD requests")
+  return found
@@ -0,0 +1,215 @@
+"""
+  typed readers for binance.vision csv files.
+
+  a reader takes the path of an extracted csv or of the downloaded zip. a zip
+  is never extracted to disk: its csv member is decompressed as it is parsed
+  straight into typed columns, so a store can keep the zips alone.
+
+  every known data type has an explicit schema: int64 times, ids and counts,
+  float64 prices and quantities, bool flags. nothing is inferred, read as
+  strings or coerced afterwards. engine='pyarrow' parses with pyarrow's
+  multithreaded csv reader instead of pandas' own, when pyarrow is installed.
+
+  binance moved its spot archives from millisecond to microsecond times in
+  2025. get_time_unit tells the two apart by magnitude and convert_time_unit
+  rescales whole columns with integer arithmetic.
+
+"""
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from enums import MERGE_CHUNK_ROWS
+
+try:
+  import pyarrow
+  from pyarrow import csv as pyarrow_csv
+except ImportError:
+  pyarrow = None
+
+KLINE_COLUMNS = {
+  'open_time': 'int64',
+  'open': 'float64',
+  'high': 'float64',
+  'low': 'float64',
+  'close': 'float64',
+  'volume': 'float64',
+  'close_time': 'int64',
+  'quote_volume': 'float64',
+  'count': 'int64',
+  'taker_buy_volume': 'float64',
+  'taker_buy_quote_volume': 'float64',
+  'ignore': 'str',
+}
+
+# spot files add is_best_match, futures files end at is_buyer_maker
+AGG_TRADE_COLUMNS = {
+  'agg_trade_id': 'int64',
+  'price': 'float64',
+  'quantity': 'float64',
+  'first_trade_id': 'int64',
+  'last_trade_id': 'int64',
+  'transact_time': 'int64',
+  'is_buyer_maker': 'bool',
+  'is_best_match': 'bool',
+}
+
+TRADE_COLUMNS = {
+  'id': 'int64',
+  'price': 'float64',
+  'qty': 'float64',
+  'quote_qty': 'float64',
+  'time': 'int64',
+  'is_buyer_maker': 'bool',
+  'is_best_match': 'bool',
+}
+
+# mark, index and premium index klines share the kline layout; their volume columns are empty
+SCHEMAS = {
+  'klines': KLINE_COLUMNS,
+  'markPriceKlines': KLINE_COLUMNS,
+  'indexPriceKlines': KLINE_COLUMNS,
+  'premiumIndexKlines': KLINE_COLUMNS,
+  'aggTrades': AGG_TRADE_COLUMNS,
+  'trades': TRADE_COLUMNS,
+}
+
+# the column each data type is ordered by
+TIME_COLUMNS = {
+  'klines': 'open_time',
+  'markPriceKlines': 'open_time',
+  'indexPriceKlines': 'open_time',
+  'premiumIndexKlines': 'open_time',
+  'aggTrades': 'transact_time',
+  'trades': 'time',
+}
+
+# the epoch time columns of each data type, in the same unit within a file
+EPOCH_COLUMNS = {
+  'klines': ['open_time', 'close_time'],
+  'markPriceKlines': ['open_time', 'close_time'],
+  'indexPriceKlines': ['open_time', 'close_time'],
+  'premiumIndexKlines': ['open_time', 'close_time'],
+  'aggTrades': ['transact_time'],
+  'trades': ['time'],
+}
+
+ENGINES = ['c', 'pyarrow']
+
+# multiples of a millisecond; ms epochs stay below MICROSECONDS_FROM until the year 5138, us epochs passed it in 1973
+TIME_UNIT_FACTORS = {'ms': 1, 'us': 1000}
+TIME_UNITS = list(TIME_UNIT_FACTORS)
+MICROSECONDS_FROM = 10 ** 14
+
+PYARROW_TYPES = {
+  'int64': 'int64',
+  'float64': 'float64',
+  'bool': 'bool',
+  'str': 'string',
+}
+
+
+def open_csv(path):
+  """Binary file object for the csv at path; for a .zip, its csv member, decompressed as it is read."""
+  if str(path).endswith('.zip'):
+    with zipfile.ZipFile(path) as archive:
+      member = next(name for name in archive.namelist() if name.endswith('.csv'))
+      # the member keeps the zip's file open after the archive is closed
+      return archive.open(member)
+  return open(path, 'rb')
+
+def has_header(f):
+  # newer files start with a column-name row, older ones go straight to the data
+  first = f.read(1)
+  f.seek(0)
+  return bool(first) and not first.isdigit()
+
+def get_columns(f, data_type):
+  """(column names, has header) of the csv in the binary file object f, as typed by the schema of data_type.
+
+  A header names the columns; without one they are the first schema columns, as many as the first line has.
+  """
+  schema = SCHEMAS[data_type]
+  first_line = f.readline().decode('utf-8-sig').strip()
+  f.seek(0)
+  if not first_line:
+    return [], False
+  fields = [field.strip() for field in first_line.split(',')]
+  if has_header(f):
+    unknown = [field for field in fields if field not in schema]
+    if unknown:
+      raise ValueError(f"columns {unknown} are not in the {data_type} schema")
+    return fields, True
+  if len(fields) > len(schema):
+    raise ValueError(f"{len(fields)} columns, the {data_type} schema has {len(schema)}")
+  return list(schema)[:len(fields)], False
+
+def _pyarrow_options(schema, columns, header, block_size=None):
+  if pyarrow is None:
+    raise ImportError("engine='pyarrow' needs pyarrow, e.g. pip install pyarrow")
+  read_options = pyarrow_csv.ReadOptions(column_names=columns, skip_rows=1 if header else 0, use_threads=True,
+                                         **({'block_size': block_size} if block_size else {}))
+  convert_options = pyarrow_csv.ConvertOptions(
+    column_types={column: pyarrow.type_for_alias(PYARROW_TYPES[schema[column]]) for column in columns})
+  return read_options, convert_options
+
+def read_archive(path, data_type='klines', engine='c'):
+  """Reads a csv or zip of data_type into a DataFrame with the names and dtypes of SCHEMAS[data_type]."""
+  schema = SCHEMAS[data_type]
+  with open_csv(path) as f:
+    columns, header = get_columns(f, data_type)
+    if not columns:
+      return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in schema.items()})
+    if engine == 'pyarrow':
+      read_options, convert_options = _pyarrow_options(schema, columns, header)
+      return pyarrow_csv.read_csv(f, read_options=read_options, convert_options=convert_options).to_pandas()
+    return pd.read_csv(f, header=0 if header else None, names=columns, dtype={column: schema[column] for column in columns})
+
+def iter_archive(path, data_type='klines', chunksize=MERGE_CHUNK_ROWS, engine='c'):
+  """Reads a csv or zip of data_type as DataFrames of about chunksize rows, typed like read_archive.
+
+  With engine='pyarrow' the chunks are pyarrow's record batches, sized to match chunksize roughly.
+  """
+  schema = SCHEMAS[data_type]
+  with open_csv(path) as f:
+    columns, header = get_columns(f, data_type)
+    if not columns:
+      return
+    if engine == 'pyarrow':
+      # about 100 bytes a row in binance csvs
+      read_options, convert_options = _pyarrow_options(schema, columns, header, block_size=chunksize * 100)
+      for batch in pyarrow_csv.open_csv(f, read_options=read_options, convert_options=convert_options):
+        if batch.num_rows:
+          yield batch.to_pandas()
+      return
+    yield from pd.read_csv(f, header=0 if header else None, names=columns, dtype={column: schema[column] for column in columns},
+                           chunksize=chunksize)
+
+def get_time_unit(times):
+  """'us' or 'ms', the unit of int64 epoch times judged from their magnitude; 'ms' when there are none."""
+  times = np.asarray(times)
+  return 'us' if times.size and int(times.max()) >= MICROSECONDS_FROM else 'ms'
+
+def convert_time_unit(df, columns, from_unit, to_unit):
+  """Rescales the int64 epoch columns of df from from_unit to to_unit, one integer NumPy operation per column.
+
+  Going to ms floors, so sub-millisecond precision is lost. Returns df.
+  """
+  if from_unit == to_unit:
+    return df
+  for column in columns:
+    values = df[column].to_numpy(dtype=np.int64)
+    if TIME_UNIT_FACTORS[to_unit] > TIME_UNIT_FACTORS[from_unit]:
+      df[column] = values * (TIME_UNIT_FACTORS[to_unit] // TIME_UNIT_FACTORS[from_unit])
+    else:
+      df[column] = values // (TIME_UNIT_FACTORS[from_unit] // TIME_UNIT_FACTORS[to_unit])
+  return df
+
+def read_klines(path, engine='c'):
+  """Reads a klines csv or zip into a DataFrame with KLINE_COLUMNS names and dtypes."""
+  return read_archive(path, 'klines', engine)
+
+def iter_klines(path, chunksize=MERGE_CHUNK_ROWS, engine='c'):
+  """Reads a klines csv or zip as DataFrames of up to chunksize rows, with KLINE_COLUMNS names and dtypes."""
+  return iter_archive(path, 'klines', chunksize, engine)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+"""
+  script to refresh the archives binance.vision has re-issued.
+
+  loads the re-issue lists (updates/*.csv and updates/*.zip by default) into a
+  lookup keyed by file name, compares it with the checksums of the archives
+  already downloaded to a folder, and downloads again only those that still
+  hold the original content. each one is verified against its new .CHECKSUM,
+  extracted again when the store keeps csvs, and the merged outputs covering
+  its dates are marked stale in the manifest, so the next merge rebuilds just
+  those. the manifest only tracks klines; for other data types, such as the
+  aggTrades every list so far is about, the symbols to merge again with
+  merge_csv_by_symbol.py are listed instead.
+
+  e.g. ./refresh-reissued.py -folder ./downloaded_data -dry-run 1
+
+"""
+import os
+import sys
+import zipfile
+from argparse import ArgumentParser, RawTextHelpFormatter
+from pathlib import Path
+
+from enums import *
+from downloader import run_downloads, AdaptiveConcurrency, PlannedRequest
+from manifest import Manifest, parse_archive_name, parse_archive_path
+from reissues import load_reissue_lists, find_stale_archives
+from utility import get_download_url, read_checksum_file
+
+DEFAULT_OUTPUT_FOLDER = "./downloaded_klines"
+FAILED_DOWNLOADS_FILE = "failed_downloads.jsonl"
+
+
+def refresh_reissued_archives(stale_archives, folder, manifest, max_in_flight=MAX_IN_FLIGHT):
+  """Downloads the stale archives again and invalidates the merged outputs that cover them. Returns how many were refreshed."""
+  kept_csvs = {}
+  kept_zips = set()
+  set_aside = {}
+  planned_requests = []
+  for zip_path, url_path, entry, local_checksum in stale_archives:
+    csv_path = f"{zip_path[:-len('.zip')]}.csv"
+    if os.path.exists(csv_path):
+      kept_csvs[zip_path] = csv_path
+    if os.path.exists(zip_path):
+      kept_zips.add(zip_path)
+    # the local .CHECKSUM describes the original copy; the download fetches the current one to verify against.
+    # it is set aside rather than deleted, and put back if the original copy has to stay
+    checksum_path = f"{zip_path}.CHECKSUM"
+    if os.path.exists(checksum_path):
+      set_aside[zip_path] = f"{checksum_path}.old"
+      os.replace(checksum_path, set_aside[zip_path])
+    parsed = parse_archive_name(zip_path)
+    url = get_download_url(url_path)
+    planned_requests.append(PlannedRequest(url, zip_path, parsed[0] if parsed else None, parsed[1] if parsed else None,
+                                           checksum_url=f"{url}.CHECKSUM"))
+
+  refreshed = 0
+  remerge = set()
+
+  def handle_response(request, response):
+    nonlocal refreshed
+    zip_path = request.destination_path
+    old_checksum_path = set_aside.pop(zip_path, None)
+    if response is None or not response.ok:
+      status_code = response.status_code if response is not None else "N/A"
+      print(f"Failed to refresh {request.url} (HTTP {status_code})")
+      if old_checksum_path:
+        os.replace(old_checksum_path, f"{zip_path}.CHECKSUM")
+      return
+    if old_checksum_path:
+      os.remove(old_checksum_path)
+    checksum_path = f"{zip_path}.CHECKSUM"
+    checksum = read_checksum_file(checksum_path) if os.path.exists(checksum_path) else None
+    size = os.path.getsize(zip_path)
+    extracted_path = zip_path
+    if zip_path in kept_csvs:
+      with zipfile.ZipFile(zip_path) as archive:
+        member = next(name for name in archive.namelist() if name.endswith('.csv'))
+        archive.extract(member, Path(zip_path).parent)
+      extracted_path = kept_csvs[zip_path]
+      print(f"Unzipped: {extracted_path}")
+      if zip_path not in kept_zips:
+        os.remove(zip_path)
+    refreshed += 1
+    kind = parse_archive_path(request.url)
+    parsed = parse_archive_name(zip_path)
+    if kind is None or kind[1] != 'klines' or parsed is None:
+      # merge_csv_by_symbol.py outputs are not in the manifest
+      if kind is not None and parsed is not None:
+        remerge.add((kind[1], parsed[0]))
+      print(f"Refreshed: {zip_path}")
+      return
+    manifest.record_archive(request.url, zip_path, extracted_path, size,
+                            response.headers.get('etag', '').strip('"') or None, response.headers.get('last-modified'), checksum)
+    marked = manifest.mark_merged_stale(parsed[0], parsed[3], parsed[4], parsed[1], kind[0])
+    print(f"Refreshed: {zip_path}" + (f". Marked {marked} merged outputs stale." if marked else ""))
+
+  run_downloads(planned_requests, handle_response, max_in_flight, os.path.join(folder, FAILED_DOWNLOADS_FILE),
+                AdaptiveConcurrency(max_in_flight))
+  manifest.commit()
+  for data_type, symbol in sorted(remerge):
+    print(f"Merge {symbol} {data_type} again with merge_csv_by_symbol.py to pick up its refreshed archives")
+  return refreshed
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Download again only the archives binance.vision has re-issued since they were saved",
+                            formatter_class=RawTextHelpFormatter)
+    parser.add_argument(
+        '-folder', dest='folder', default=DEFAULT_OUTPUT_FOLDER,
+        help='Folder the archives were downloaded to, default {}'.format(DEFAULT_OUTPUT_FOLDER))
+    parser.add_argument(
+        '-updates', dest='updates', nargs='+',
+        help='Re-issue lists (.csv or .zip) to apply, default every list in the updates folder of this repository')
+    parser.add_argument(
+        '-max-in-flight', dest='max_in_flight', default=MAX_IN_FLIGHT, type=int,
+        help='Maximum number of downloads in flight, default {}'.format(MAX_IN_FLIGHT))
+    parser.add_argument(
+        '-dry-run', dest='dry_run', default=0, type=int, choices=[0, 1],
+        help='1 to only list the archives that would be downloaded again, default 0')
+    args = parser.parse_args(sys.argv[1:])
+
+    reissued = load_reissue_lists(args.updates)
+    print(f"Loaded {len(reissued)} re-issued archives")
+    manifest = Manifest(args.folder)
+    stale_archives = find_stale_archives(reissued, args.folder, manifest.archive_checksums())
+    for zip_path, url_path, entry, local_checksum in stale_archives:
+        state = "original copy" if local_checksum == entry['original'] else "unknown copy" if local_checksum is None else "other copy"
+        print(f"Stale: {zip_path} ({state})")
+    print(f"Found {len(stale_archives)} archives to refresh in {args.folder}")
+
+    if stale_archives and args.dry_run == 0:
+        refreshed = refresh_reissued_archives(stale_archives, args.folder, manifest, args.max_in_flight)
+        print(f"Refreshed {refreshed} of {len(stale_archives)} archives")
+    manifest.close()
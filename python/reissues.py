@@ -0,0 +1,121 @@
+"""
+  re-issue lists published by binance.vision.
+
+  when archives are regenerated upstream, binance publishes a list such as
+  updates/2022-10-04_aggregate_trade_updates.csv, sometimes zipped, that maps
+  every re-issued file to its original and new sha256. these helpers load the
+  lists into one lookup keyed by archive file name and compare it with the
+  checksums of a local store, so only archives still holding the original
+  content need to be fetched again.
+
+"""
+import csv
+import io
+import os
+import zipfile
+from pathlib import Path
+
+from utility import read_checksum_file, sha256_of_mmap
+
+UPDATES_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'updates')
+
+
+def _checksum(value):
+  # checksum cells are "<sha256>  <file name>", like a .CHECKSUM file
+  return value.split()[0].lower() if value and value.strip() else None
+
+def _archive_name(name):
+  name = name.rsplit('/', 1)[-1]
+  return name if name.endswith('.zip') else f"{name}.zip"
+
+def read_reissue_list(f):
+  """{file name: {'path', 'original', 'new'}} from one re-issue list read from the text file object f.
+
+  Lists name the archive either by 'File' (no extension) or by its bucket 'File Path';
+  'path' is None for the former.
+  """
+  reissued = {}
+  for row in csv.DictReader(f):
+    row = {key.strip(): value for key, value in row.items() if key}
+    location = row.get('File Path') or row.get('File')
+    if not location:
+      continue
+    reissued[_archive_name(location)] = {
+      'path': row.get('File Path'),
+      'original': _checksum(row.get('Original File Checksum')),
+      'new': _checksum(row.get('New File Checksum')),
+    }
+  return reissued
+
+def load_reissue_list(path):
+  """Reads a re-issue list from a .csv, or from the csv inside a .zip without extracting it."""
+  if str(path).endswith('.zip'):
+    with zipfile.ZipFile(path) as archive:
+      # skip the resource forks macOS adds to zips it creates
+      member = next(name for name in archive.namelist() if name.endswith('.csv') and not name.startswith('__MACOSX/'))
+      return read_reissue_list(io.TextIOWrapper(io.BytesIO(archive.read(member)), encoding='utf-8-sig'))
+  with open(path, newline='', encoding='utf-8-sig') as f:
+    return read_reissue_list(f)
+
+def load_reissue_lists(paths=None):
+  """Merges every list into one {file name: entry} lookup. Lists are applied oldest first, by their dated file names,
+  so the latest re-issue of a file wins. paths defaults to every .csv and .zip in UPDATES_FOLDER."""
+  if paths is None:
+    paths = [path for path in Path(UPDATES_FOLDER).glob('*') if path.suffix in ('.csv', '.zip')]
+  reissued = {}
+  for path in sorted(paths, key=lambda path: Path(path).name):
+    reissued.update(load_reissue_list(path))
+  return reissued
+
+def get_archive_url_path(folder, local_path, file_name):
+  """Bucket path of the archive a file in folder came from, e.g. data/spot/monthly/aggTrades/ETHBTC/<file name>.
+
+  Drops the date range folder the older download scripts nest under the symbol folder.
+  """
+  parts = Path(local_path).relative_to(folder).parts
+  symbol = file_name.split('-')[0]
+  if symbol not in parts:
+    return None
+  return '/'.join(parts[:parts.index(symbol) + 1] + (file_name,))
+
+def get_local_checksum(zip_path, recorded=None):
+  """sha256 of what the store holds for zip_path: the zip itself when it is kept, else its .CHECKSUM, else recorded."""
+  if os.path.exists(zip_path):
+    return sha256_of_mmap(zip_path)
+  checksum_path = f"{zip_path}.CHECKSUM"
+  if os.path.exists(checksum_path):
+    return read_checksum_file(checksum_path)
+  return recorded
+
+def find_stale_archives(reissued, folder, recorded_checksums=None):
+  """[(zip path, url path, entry, local checksum)] for every archive in folder/data that was re-issued and is not up to date.
+
+  An archive is looked up by file name, through its zip, its .CHECKSUM or its extracted csv.
+  It is up to date once its checksum matches the new one. One whose checksum is unknown is
+  reported too, since there is no telling which copy it holds. recorded_checksums maps zip
+  paths, made absolute, to checksums kept elsewhere, e.g. in the manifest.
+  """
+  recorded_checksums = recorded_checksums or {}
+  data_root = Path(folder) / 'data'
+  if not reissued or not data_root.is_dir():
+    return []
+  local_archives = {}
+  for path in data_root.rglob('*'):
+    name = path.name
+    if name.endswith('.zip.CHECKSUM'):
+      name = name[:-len('.CHECKSUM')]
+    elif name.endswith('.csv'):
+      name = f"{name[:-len('.csv')]}.zip"
+    if name in reissued:
+      local_archives.setdefault(str(path.parent / name), name)
+
+  stale = []
+  for zip_path, name in sorted(local_archives.items()):
+    entry = reissued[name]
+    local_checksum = get_local_checksum(zip_path, recorded_checksums.get(os.path.abspath(zip_path)))
+    if local_checksum is not None and local_checksum == entry['new']:
+      continue
+    url_path = entry['path'] or get_archive_url_path(folder, zip_path, name)
+    if url_path:
+      stale.append((zip_path, url_path, entry, local_checksum))
+  return stale
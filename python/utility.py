@@ -1,8 +1,14 @@
 import os, sys, re, shutil
 import json
+import hashlib
+import mmap
+import zipfile
 from pathlib import Path
 from datetime import *
-import urllib.request
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
 from argparse import ArgumentParser, RawTextHelpFormatter, ArgumentTypeError
 from enums import *
 
@@ -17,16 +23,116 @@ def get_destination_dir(file_url, folder=None):
 def get_download_url(file_url):
   return "{}{}".format(BASE_URL, file_url)
 
-def get_all_symbols(type):
+def get_listing_url():
+  return os.environ.get('LISTING_URL', LISTING_URL)
+
+def get_exchange_info_url(type):
   if type == 'um':
-    response = urllib.request.urlopen("https://fapi.binance.com/fapi/v1/exchangeInfo").read()
+    return "https://fapi.binance.com/fapi/v1/exchangeInfo"
   elif type == 'cm':
-    response = urllib.request.urlopen("https://dapi.binance.com/dapi/v1/exchangeInfo").read()
-  else:
-    response = urllib.request.urlopen("https://api.binance.com/api/v3/exchangeInfo").read()
-  return list(map(lambda symbol: symbol['symbol'], json.loads(response)['symbols']))
+    return "https://dapi.binance.com/dapi/v1/exchangeInfo"
+  return "https://api.binance.com/api/v3/exchangeInfo"
+
+def get_symbol_catalogue(type, folder=None, ttl=EXCHANGE_INFO_TTL):
+  """Returns {symbol: {'status', 'quoteAsset', 'contractType', 'onboardDate'}} from exchangeInfo.
+
+  The catalogue is cached as exchangeInfo-<type>.json in folder (or STORE_DIRECTORY)
+  and only refetched once it is older than ttl. If the API cannot be reached
+  an older cache is used instead; a cache that cannot be read counts as none.
+  onboardDate is a YYYY-MM-DD string and, like contractType, only exists for futures.
+  """
+  cache_path = get_destination_dir("exchangeInfo-{}.json".format(type), folder)
+  cached = None
+  if os.path.exists(cache_path):
+    try:
+      with open(cache_path) as f:
+        cached = json.load(f)
+      fetched_at = datetime.fromisoformat(cached['fetched_at'])
+      cached_symbols = cached['symbols']
+    except (ValueError, KeyError, TypeError) as e:
+      # e.g. cut short by an older run that was interrupted while writing it
+      print("Ignoring unreadable exchangeInfo cache {} ({})".format(cache_path, e))
+      cached = None
+    else:
+      if datetime.now(timezone.utc) - fetched_at < ttl:
+        return cached_symbols
+
+  try:
+    response = get_session().get(get_exchange_info_url(type), timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    exchange_info = response.json()
+  except (requests.RequestException, ValueError) as e:
+    if cached is None:
+      raise
+    print("Could not refresh exchangeInfo ({}), using the copy cached at {}".format(e, cached['fetched_at']))
+    return cached_symbols
+
+  symbols = {}
+  for info in exchange_info['symbols']:
+    onboard_date = info.get('onboardDate')
+    symbols[info['symbol']] = {
+      # coin-m reports contractStatus instead of status
+      'status': info.get('status', info.get('contractStatus')),
+      'quoteAsset': info.get('quoteAsset'),
+      'contractType': info.get('contractType'),
+      'onboardDate': datetime.fromtimestamp(onboard_date / 1000, timezone.utc).strftime('%Y-%m-%d') if onboard_date else None,
+    }
+  Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+  # written aside and renamed, so an interrupted write never leaves a truncated cache
+  tmp_path = "{}.tmp".format(cache_path)
+  with open(tmp_path, 'w') as f:
+    json.dump({'fetched_at': datetime.now(timezone.utc).isoformat(timespec='seconds'), 'symbols': symbols}, f)
+  os.replace(tmp_path, cache_path)
+  return symbols
+
+def get_all_symbols(type, folder=None):
+  return list(get_symbol_catalogue(type, folder))
+
+def filter_symbols(catalogue, symbols, active_only=0, quote_assets=None):
+  """Drops the symbols that are not trading (with active_only=1) or not quoted in quote_assets.
+
+  Symbols missing from the catalogue are kept, since it cannot say anything about them.
+  """
+  kept = []
+  for symbol in symbols:
+    info = catalogue.get(symbol.upper())
+    if info is not None:
+      if active_only == 1 and info['status'] != 'TRADING':
+        continue
+      if quote_assets and info['quoteAsset'] not in quote_assets:
+        continue
+    kept.append(symbol)
+  return kept
 
-def download_file(base_path, file_name, date_range=None, folder=None):
+_session = None
+_session_pool_size = 0
+_session_lock = threading.Lock()
+
+def get_session(pool_size=MAX_IN_FLIGHT):
+  """Returns the keep-alive session shared by every download in this process.
+
+  Its connection pool holds at least pool_size connections: asking for more than
+  an earlier call did mounts a larger pool, so the first caller does not fix its size.
+  """
+  global _session, _session_pool_size
+  with _session_lock:
+    if _session is None:
+      _session = requests.Session()
+    if pool_size > _session_pool_size:
+      # connections already checked out of the old pool finish on it
+      adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=2)
+      _session.mount('https://', adapter)
+      _session.mount('http://', adapter)
+      _session_pool_size = pool_size
+  return _session
+
+def download_file(base_path, file_name, date_range=None, folder=None, checksum=0, show_progress=True):
+  """Downloads base_path/file_name into folder, resuming a partial copy.
+
+  With checksum=1 an archive fetches its .CHECKSUM alongside and is verified as it
+  streams; a mismatch is quarantined and downloaded again, up to MAX_RETRIES times.
+  Returns False when the archive failed verification every time, else True.
+  """
   download_path = "{}{}".format(base_path, file_name)
   if folder:
     base_path = os.path.join(folder, base_path)
@@ -37,37 +143,251 @@ def download_file(base_path, file_name, date_range=None, folder=None):
   
 
   if os.path.exists(save_path):
-    print("\nfile already exists! {}".format(save_path))
-    return
+    if save_path.endswith('.zip') and not zipfile.is_zipfile(save_path):
+      # a truncated archive from an older run is a valid prefix, so resume it
+      print("\nfile is incomplete, resuming: {}".format(save_path))
+      os.replace(save_path, get_part_path(save_path))
+    else:
+      print("\nfile already exists! {}".format(save_path))
+      return True
   
   # make the directory
   if not os.path.exists(base_path):
     Path(get_destination_dir(base_path)).mkdir(parents=True, exist_ok=True)
 
-  try:
-    download_url = get_download_url(download_path)
-    dl_file = urllib.request.urlopen(download_url)
-    length = dl_file.getheader('content-length')
-    if length:
-      length = int(length)
-      blocksize = max(4096,length//100)
-
-    with open(save_path, 'wb') as out_file:
-      dl_progress = 0
+  download_url = get_download_url(download_path)
+
+  def draw_progress(dl_progress, length):
+    done = int(50 * dl_progress / length)
+    sys.stdout.write("\r[%s%s]" % ('#' * done, '.' * (50-done)) )    
+    sys.stdout.flush()
+
+  checksum_url = "{}.CHECKSUM".format(download_url) if checksum == 1 and file_name.endswith('.zip') else None
+  for attempt in range(MAX_RETRIES):
+    try:
       print("\nFile Download: {}".format(save_path))
-      while True:
-        buf = dl_file.read(blocksize)   
-        if not buf:
-          break
-        dl_progress += len(buf)
-        out_file.write(buf)
-        done = int(50 * dl_progress / length)
-        sys.stdout.write("\r[%s%s]" % ('#' * done, '.' * (50-done)) )    
-        sys.stdout.flush()
-
-  except urllib.error.HTTPError:
-    print("\nFile not found: {}".format(download_url))
-    pass
+      response = fetch_to_file(get_session(), download_url, save_path, on_progress=draw_progress if show_progress else None,
+                               checksum_url=checksum_url)
+      if response.status_code == 404:
+        print("\nFile not found: {}".format(download_url))
+      elif not response.ok:
+        print("\nFailed to download {}: HTTP {}".format(download_url, response.status_code))
+      return True
+    except ChecksumMismatchError as e:
+      print("\n{} (attempt {}/{})".format(e, attempt + 1, MAX_RETRIES))
+    except (requests.RequestException, OSError) as e:
+      print("\nFailed to download {}: {}".format(download_url, e))
+      return True
+  return False
+
+def get_part_path(save_path):
+  return "{}.part".format(save_path)
+
+def get_validator_path(save_path):
+  # the ETag or Last-Modified of the object a .part was started from
+  return "{}.part.validator".format(save_path)
+
+def get_range_validator(response):
+  """Strong ETag, else Last-Modified, of a response, for If-Range; None when it has neither."""
+  etag = response.headers.get('etag')
+  if etag and not etag.startswith('W/'):
+    return etag
+  return response.headers.get('last-modified')
+
+def get_content_range_total(content_range):
+  # "bytes 100-199/200" or "bytes */200"
+  if not content_range or '/' not in content_range:
+    return None
+  total = content_range.rsplit('/', 1)[1].strip()
+  return int(total) if total.isdigit() else None
+
+def sha256_of_file(file_path, blocksize=DOWNLOAD_CHUNK_SIZE, digest=None):
+  """Hex sha256 of the file, or of the bytes fed to digest so far followed by the file when digest is given."""
+  digest = digest or hashlib.sha256()
+  with open(file_path, 'rb') as f:
+    for buf in iter(lambda: f.read(blocksize), b''):
+      digest.update(buf)
+  return digest.hexdigest()
+
+def sha256_of_mmap(file_path):
+  """Hex sha256 of the file, hashed straight from a read-only memory map. Module level, so process pools can run it."""
+  with open(file_path, 'rb') as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      return hashlib.sha256().hexdigest()
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+      return hashlib.sha256(mapped).hexdigest()
+
+def quarantine_file(file_path, save_path=None):
+  """Moves a corrupt file aside to <save_path>.corrupt (save_path defaults to file_path), replacing an older one, and returns the new path."""
+  quarantine_path = "{}{}".format(save_path or file_path, QUARANTINE_SUFFIX)
+  os.replace(file_path, quarantine_path)
+  return quarantine_path
+
+def read_checksum_file(checksum_path):
+  # .CHECKSUM files hold "<sha256>  <file name>"
+  with open(checksum_path) as f:
+    return f.read().split()[0].lower()
+
+def stream_to_file(response, part_path, resume_from=0, blocksize=DOWNLOAD_CHUNK_SIZE, on_progress=None, digest=None):
+  """Appends a streamed response body to part_path one block at a time, so at most one block per download is held in memory.
+
+  Each block is also fed to digest, if given, so the file never has to be read back to be hashed.
+  """
+  written = resume_from
+  with open(part_path, 'ab' if resume_from else 'wb') as out_file:
+    for buf in response.iter_content(blocksize):
+      out_file.write(buf)
+      if digest is not None:
+        digest.update(buf)
+      written += len(buf)
+      if on_progress:
+        on_progress(written)
+  return written
+
+def fetch_to_file(session, url, save_path, on_progress=None, etag=None, last_modified=None, checksum_url=None):
+  """Downloads url to save_path through save_path.part, resuming an interrupted .part with a Range request.
+
+  The .part is only renamed to save_path once its size matches the full object
+  size the server reported (and, for archives, once it reads as a zip whose sha256
+  matches its .CHECKSUM), so save_path never holds a truncated or corrupt file.
+  A .part cut off by a dropped connection is kept for the next attempt, along with
+  the validator of the object it came from. The resume sends it as If-Range, so an
+  object changed since comes back whole and the .part starts over; a .part without
+  one starts over right away. A .part that already holds the whole object, left by a
+  failed .CHECKSUM fetch or a crash before the rename, is finished as it is. Returns
+  the response, whose body has already been consumed.
+
+  An archive is hashed while it streams. It is checked against the .CHECKSUM
+  next to save_path, which is fetched from checksum_url first if it is not there
+  yet. A mismatch is quarantined to save_path.corrupt and raises
+  ChecksumMismatchError, a CorruptArchiveError, so the download engine retries it.
+
+  With the etag and/or last_modified of a copy downloaded earlier the request is
+  conditional, and a 304 response is returned without touching save_path.
+  """
+  Path(save_path).parent.mkdir(parents=True, exist_ok=True)
+  part_path = get_part_path(save_path)
+  validator_path = get_validator_path(save_path)
+  offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+  if offset and not os.path.exists(validator_path):
+    # nothing to tell whether the .part is still a prefix of the object
+    os.remove(part_path)
+    offset = 0
+  headers = {'Accept-Encoding': 'identity'}
+  if offset:
+    headers['Range'] = 'bytes={}-'.format(offset)
+    with open(validator_path) as f:
+      headers['If-Range'] = f.read().strip()
+  else:
+    if etag:
+      headers['If-None-Match'] = '"{}"'.format(etag)
+    if last_modified:
+      headers['If-Modified-Since'] = last_modified
+
+  with session.get(url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as response:
+    complete = response.status_code == 416 and offset and \
+      get_content_range_total(response.headers.get('content-range')) == offset
+    if response.status_code == 416 and offset and not complete:
+      # the .part is not a prefix of the current object; start over
+      os.remove(part_path)
+      os.remove(validator_path)
+      return fetch_to_file(session, url, save_path, on_progress, etag, last_modified, checksum_url)
+    if not complete and (not response.ok or response.status_code == 304):
+      return response
+
+    if complete:
+      # the If-Range validator still matched and nothing is left to fetch
+      total = offset
+    elif response.status_code == 206:
+      total = get_content_range_total(response.headers.get('content-range'))
+    else:
+      # a fresh start, or the object changed since the .part was started
+      offset = 0
+      length = response.headers.get('content-length')
+      total = int(length) if length else None
+      validator = get_range_validator(response)
+      if validator:
+        with open(validator_path, 'w') as f:
+          f.write(validator)
+      elif os.path.exists(validator_path):
+        os.remove(validator_path)
+    progress = (lambda written: on_progress(written, total)) if on_progress and total else None
+    digest = None
+    if save_path.endswith('.zip'):
+      digest = hashlib.sha256()
+      if offset:
+        # the resumed bytes were hashed by an earlier attempt that is gone, so hash them again
+        sha256_of_file(part_path, digest=digest)
+    written = offset if complete else stream_to_file(response, part_path, offset, on_progress=progress, digest=digest)
+
+  if total is not None and written != total:
+    raise IOError("incomplete download of {}: {} of {} bytes".format(url, written, total))
+  try:
+    if save_path.endswith('.zip'):
+      if not zipfile.is_zipfile(part_path):
+        os.remove(part_path)
+        raise CorruptArchiveError("corrupt archive from {}, discarded".format(url))
+      verify_archive_checksum(session, url, save_path, part_path, digest.hexdigest(), checksum_url)
+    os.replace(part_path, save_path)
+  finally:
+    # the validator goes with its .part, whether it was completed, discarded or quarantined
+    if not os.path.exists(part_path) and os.path.exists(validator_path):
+      os.remove(validator_path)
+  if complete:
+    # callers go by the status, and save_path is now as whole as after a 200
+    response.status_code = 200
+  return response
+
+class CorruptArchiveError(IOError):
+  """An archive came down in full but its content is wrong; nothing to do with how busy the server is."""
+
+class ChecksumMismatchError(CorruptArchiveError):
+  pass
+
+def get_expected_checksum(session, checksum_path, checksum_url=None, refresh=False):
+  """sha256 from the .CHECKSUM at checksum_path, downloading it from checksum_url when it is missing or refresh is set.
+
+  Returns None when there is no .CHECKSUM to compare against.
+  """
+  if checksum_url and (refresh or not os.path.exists(checksum_path)):
+    response = fetch_to_file(session, checksum_url, checksum_path)
+    if not response.ok and response.status_code != 404:
+      response.raise_for_status()
+  if not os.path.exists(checksum_path):
+    return None
+  return read_checksum_file(checksum_path)
+
+def verify_archive_checksum(session, url, save_path, part_path, actual, checksum_url=None):
+  """Compares the sha256 of a downloaded archive with its .CHECKSUM, quarantining the .part on a mismatch."""
+  checksum_path = "{}.CHECKSUM".format(save_path)
+  had_checksum = os.path.exists(checksum_path)
+  expected = get_expected_checksum(session, checksum_path, checksum_url)
+  if expected is not None and expected != actual and had_checksum and checksum_url:
+    # the archive may have been re-issued since the local .CHECKSUM was saved
+    expected = get_expected_checksum(session, checksum_path, checksum_url, refresh=True)
+  if expected is not None and expected != actual:
+    quarantine_path = quarantine_file(part_path, save_path)
+    raise ChecksumMismatchError("checksum mismatch for {}: expected {}, got {}. Quarantined to {}".format(
+      url, expected, actual, quarantine_path))
+
+def download_files(jobs, max_in_flight=MAX_IN_FLIGHT):
+  """Runs download_file for every (base_path, file_name, date_range, folder, checksum) job, max_in_flight at a time over the shared session.
+
+  Returns the jobs whose archive never matched its .CHECKSUM, after listing them.
+  """
+  max_in_flight = max(1, int(max_in_flight))
+  get_session(max_in_flight)
+  if max_in_flight == 1:
+    verified = [download_file(*job) for job in jobs]
+  else:
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+      verified = list(pool.map(lambda job: download_file(*job, show_progress=False), jobs))
+  mismatched = [job for job, ok in zip(jobs, verified) if not ok]
+  if mismatched:
+    print("\n{} archives failed checksum verification and were quarantined:".format(len(mismatched)))
+    for job in mismatched:
+      print("  {}{}".format(job[0], job[1]))
+  return mismatched
 
 def convert_to_date_object(d):
   year, month, day = [int(x) for x in d.split('-')]
@@ -144,6 +464,9 @@ def get_parser(parser_type):
   parser.add_argument(
       '-c', dest='checksum', default=0, type=int, choices=[0,1],
       help='1 to download checksum file, default 0')
+  parser.add_argument(
+      '-max-in-flight', dest='max_in_flight', default=MAX_IN_FLIGHT, type=int,
+      help='Maximum number of downloads running at once, default {}'.format(MAX_IN_FLIGHT))
   parser.add_argument(
       '-t', dest='type', required=True, choices=TRADING_TYPE,
       help='Valid trading types: {}'.format(TRADING_TYPE))